@@ -1,9 +1,20 @@
+import heapq
 import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from functools import cmp_to_key, partial
+from operator import attrgetter, methodcaller
 
 from django.template.defaultfilters import slugify
 from django.utils.datastructures import SortedDict
 
-from .utils import get_verbose_name, is_iterable
+from .bitmaps import ItemBitmap, ItemRegistry
+from .itemsets import ChunkedItemSet, working_copy
+from .snapshot import Snapshot, write_snapshot
+from .storage import decode_items, decode_value, encode_items, encode_value
+from .utils import count_sort_key, get_path_values, get_verbose_name, \
+    intersection_count, is_iterable, sort_by_count
 
 class FacetLabel(object):
     def __init__(
@@ -28,6 +39,7 @@ class FacetLabel(object):
         self._items = self.initialise_items()
         self.is_all = is_all
         self._matching_items = None
+        self._count = None
         self.is_selected = is_selected
         self.is_default = is_default
 
@@ -36,18 +48,41 @@ class FacetLabel(object):
         return self._items
 
     def set_items(self, val, inhibit_save=False):
-        self._items = val
+        facet_label = self.facet.writable_label(self)
+        facet_label._items = val
+        self.facet._item_labels = None
         if not inhibit_save:
-            self.save()
+            facet_label.save()
 
     def add_item(self, item, inhibit_save=False):
         # Assume we have a single item
-        self._items.add(item)
+        facet_label = self.facet.writable_label(self)
+        facet_label.writable_items().add(item)
+        item_labels = self.facet._item_labels
+        if item_labels is not None and not self.is_all:
+            slugs = item_labels.get(item, ())
+            if self.slug not in slugs:
+                item_labels[item] = slugs + (self.slug,)
         if not inhibit_save:
-            self.save()
+            facet_label.save()
+
+    def writable_items(self):
+        """
+        Return my items, to change in place. During an update of the group,
+        that's a copy of them, held by the copy of me that replaces me in my
+        facet (see `Facet.writable_label`).
+        """
+        facet_label = self.facet.writable_label(self)
+        items = self.facet.group.writable(facet_label, '_items',
+                                          methodcaller('copy'))
+        if getattr(items, 'read_only', False):
+            # a view of a snapshot (see facettools.snapshot), outside an
+            # update: it's copied all the same
+            items = facet_label._items = items.copy()
+        return items
 
     def clear_items(self, inhibit_save=False):
-        self.set_items(set(), inhibit_save)
+        self.set_items(self.facet.group.new_item_set(), inhibit_save)
 
     def matching_items(self):
         """
@@ -79,10 +114,29 @@ class FacetLabel(object):
 
     def invalidate(self):
         self._matching_items = None
+        self._count = None
+
+    def copy_for(self, facet):
+        """
+        Return a copy of this label for `facet` (a copy of my facet), that
+        shares my items, but has its own selection state and cached results.
+        """
+        facet_label = object.__new__(self.__class__)
+        facet_label.__dict__.update(self.__dict__)
+        facet_label.facet = facet
+        facet_label.invalidate()
+        return facet_label
 
     @property
     def count(self):
-        return len(self.matching_items())
+        if self._count is None:
+            # counts are cheapest worked out for all of a facet's labels at
+            # once, since they share the other facets' intersection.
+            count = self.facet.counts().get(self.slug)
+            if count is None: # we're not in the facet (any more)
+                count = self.facet.count_label(self)
+            self._count = count
+        return self._count
 
     @property
     def key(self):
@@ -102,18 +156,88 @@ class FacetLabel(object):
                                   self.count)
 
     def initialise_items(self):
-        # subclasses may retrieve a stored set for this label
-        return set()
+        items = self.facet.group.new_item_set()
+        # retrieve the stored set for this label, if we're loading the index
+        if self.slug in self.facet._stored_slugs:
+            data = self.facet.group.load_stored(self.key)
+            if data is not None:
+                for key in decode_items(data):
+                    items.add(key)
+        return items
 
     def save(self):
-        # a no-op, but used in subclasses that provide storage
-        pass
+        # a no-op, unless the group has storage
+        self.facet.group.store(self.key, partial(encode_items, self.items))
+
+class LabelCopies(object):
+    """
+    The labels of a copy of a facet (see `Facet.copy_for`), by slug. Each is
+    copied from the original facet's labels when it is first looked up, as
+    a request only uses (and selects and counts) a few of a large facet's.
+
+    Supports the read-only part of the `dict` API that facets use.
+    """
+
+    def __init__(self, facet, labels):
+        self.facet = facet
+        # the original facet's labels, and the copies made so far, by slug
+        self.labels = labels
+        self.copies = {}
+
+    def __getitem__(self, slug):
+        try:
+            return self.copies[slug]
+        except KeyError:
+            facet_label = self.copies[slug] = \
+                self.labels[slug].copy_for(self.facet)
+            return facet_label
+
+    def get(self, slug, default=None):
+        try:
+            return self[slug]
+        except KeyError:
+            return default
+
+    def __contains__(self, slug):
+        return slug in self.labels
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def keys(self):
+        return self.labels.keys()
+
+    def values(self):
+        return [self[slug] for slug in self.labels]
+
+    def items(self):
+        return [(slug, self[slug]) for slug in self.labels]
+
+    def selected(self):
+        """
+        Return the selected labels, copying only those.
+        """
+        copies = self.copies
+        return [self[slug] for slug, facet_label in self.labels.items()
+                if copies.get(slug, facet_label).is_selected]
+
 
 class Facet(object):
     """
     A collection of FacetLabels, that is in turn grouped in a FacetGroup
     """
     _FacetLabelClass = FacetLabel
+    # whether write_snapshot can store my index, as my labels' items
+    supports_snapshots = True
+    # the facet of the shared index that I'm a selection's copy of, if any
+    _source = None
+    # the attributes that hold my index, rather than my settings, which a
+    # selection takes from the last published index (see `published_copy`)
+    index_attributes = ('_label_dict', '_label_order', '_item_labels',
+                        '_stored_slugs')
 
     def __init__(self,
          name,
@@ -122,11 +246,18 @@ class Facet(object):
          all_label="all",
          all_label_slug=None,
          cmp_func=None,
+         sort_key=None, #a function of a label to sort labels by; faster than cmp_func, which it overrides
+         limit=None, #if given, only this many labels (besides 'all' and selected ones) are sorted into `labels`: the first ones
          select_multiple=False,
          intersect_if_multiple=False,
          default_selected_slugs=None, #a list of labels (strings) to select by default
          #TODO: if default_selected_slugs == True, then all labels are selected by default.
          hide_all=False, #set to true to prevent the "all_label" from being used or shown.
+         select_related=None, #related fields that get_FOO_facet follows, loaded in bulk when indexing
+         prefetch_related=None, #as above, for m2m and reverse relations
+         field=None, #a lookup path (e.g. "colours__name"), whose last attribute may be a property, to read labels from, instead of get_FOO_facet
+         depends_on=None, #the fields and relations of the item that labels are read from, so that saves that change none of them can skip reindexing this facet
+         related=None, #{related model: lookup path from the item to it, e.g. "colours"}, whose changes reindex the items that relate to them
     ):
         self.group = group
         self.name = name
@@ -143,6 +274,18 @@ class Facet(object):
             self.cmp_func = cmp_func
         else:
             self.cmp_func = lambda a, b: cmp(a.slug, b.slug)
+        # whether the order of labels depends on their counts (and so on the
+        # selection); if not, it's kept until the index changes.
+        self.sort_uses_counts = sort_key is not None or cmp_func is not None
+        if sort_key is None:
+            if cmp_func is None:
+                sort_key = attrgetter('slug')
+            elif cmp_func is sort_by_count:
+                sort_key = count_sort_key
+            else:
+                sort_key = cmp_to_key(cmp_func)
+        self.sort_key = sort_key
+        self.limit = limit
         self.select_multiple = select_multiple
         self.intersect_if_multiple = intersect_if_multiple
 
@@ -154,12 +297,19 @@ class Facet(object):
             self.default_selected_slugs = [default_selected_slugs]
 
         self.hide_all=hide_all
+        self.select_related = select_related or []
+        self.prefetch_related = prefetch_related or []
+        self.field = field
+        if depends_on is None and field is not None:
+            depends_on = [field.split('__')[0]]
+        self.depends_on = depends_on
+        self.related = related or {}
 
         self.clear_items()
 
     @property
     def key(self):
-        return "%s__%s" % (self.group.key(), self.slug)
+        return "%s__%s" % (self.group.key, self.slug)
 
     def __getitem__(self, item):
         if isinstance(item, int):
@@ -170,9 +320,19 @@ class Facet(object):
     def clear_items(self):
         """
         Clearing items on a facet means resetting labels.
-        Subclasses that implement storage may want to purge the cache.
         """
+        # slugs of the labels to retrieve from storage as they are created
+        self._stored_slugs = set()
         self._label_dict = {}
+        # (index generation, slugs of the labels other than 'all' in order),
+        # if my order doesn't depend on counts (see `sorted_slugs`).
+        # Selections read and keep it on the published copy of me they were
+        # copied from.
+        self._label_order = None
+        # item key -> slugs of the labels (other than 'all') that hold it, for
+        # unindexing. Built when first needed (see `item_labels`), then kept
+        # up to date by writers; readers don't use it.
+        self._item_labels = None
 
         if not self.hide_all:
             self._label_dict[self.all_label_slug] = self._FacetLabelClass(
@@ -185,69 +345,302 @@ class Facet(object):
         self.labels = None # a sorted list of FacetLabels objects for
         # displaying, generated by calling update()
         self._matching_items = None
+        # slug -> count of every label, worked out when first needed (see
+        # `counts`)
+        self._counts = None
+
+    def get_labels(self, item):
+        """
+        Return the label(s) of `item` in this facet: the values found at
+        `field`, if given, otherwise the result of get_FOO_facet.
+        """
+        if self.field is not None:
+            return get_path_values(item, self.field)
 
-    def index_item(self, item, inhibit_save=False):
         # call get_FOO_facet on the item
         attr_name = "get_%s_facet" % self.slug.replace("-", "")
         attr = getattr(self.group, attr_name, None)
 
         if attr:
-            facet_labels = attr(item)
+            return attr(item)
         else:
             attr = getattr(item, attr_name, None)
             if attr:
-                facet_labels = attr()
+                return attr()
             else:
-                facet_labels = None
+                return None
+
+    def index_item(self, item, inhibit_save=False):
+        # the index stores keys (by default, the item itself)
+        self.index_key(self.group.item_key(item), self.get_labels(item),
+                       inhibit_save)
 
+    def index_key(self, key, facet_labels, inhibit_save=False):
+        """
+        Index an item by its key, given its label(s) in this facet.
+        """
+        self.group.touch(key)
         if facet_labels is not None:
             if not is_iterable(facet_labels):
                 facet_labels = [facet_labels]
-            self.index_labels(facet_labels, item, inhibit_save)
+            self.index_labels(facet_labels, key, inhibit_save)
 
         # add every item to the 'all' facet
         if not self.hide_all:
-            self._label_dict[self.all_label_slug].add_item(item)
+            self._label_dict[self.all_label_slug].add_item(key, inhibit_save)
+
+    def item_labels(self, key):
+        """
+        Return the slugs of the labels (other than 'all') that hold the item
+        with `key`.
+        """
+        if self._item_labels is None:
+            # build the reverse index the first time it's needed, rather
+            # than pay for it while rebuilding
+            item_labels = {}
+            for slug, facet_label in self._label_dict.items():
+                if not facet_label.is_all:
+                    for k in facet_label.items:
+                        item_labels[k] = item_labels.get(k, ()) + (slug,)
+            self._item_labels = item_labels
+        return self._item_labels.get(key, ())
 
     def unindex_item(self, item, inhibit_save=False):
-        labels_to_remove = set()
-        for facet_label in self._label_dict.values():
-            facet_label.items.discard(item)
-            if len(facet_label.items) == 0: #empty label! delete it.
-                labels_to_remove.add(facet_label.slug)
-            if not inhibit_save:
-                facet_label.save()
+        self.unindex_key(self.group.item_key(item), inhibit_save)
 
-        for v in labels_to_remove:
-            del self._label_dict[v]
+    def unindex_key(self, key, inhibit_save=False):
+        self.group.touch(key)
+        slugs = list(self.item_labels(key))
+        self._item_labels.pop(key, None)
+        if not self.hide_all:
+            slugs.append(self.all_label_slug)
+
+        changed = []
+        labels_to_remove = set()
+        for slug in slugs:
+            facet_label = self._label_dict.get(slug)
+            if facet_label is None or key not in facet_label.items:
+                continue
+            facet_label = self.writable_label(facet_label)
+            items = facet_label.writable_items()
+            items.discard(key)
+            if len(items) == 0 and not facet_label.is_all:
+                #empty label! delete it.
+                labels_to_remove.add(slug)
+            else:
+                changed.append(facet_label)
+
+        if labels_to_remove:
+            label_dict = self.writable_label_dict()
+            for v in labels_to_remove:
+                del label_dict[v]
+        if not inhibit_save and self.group.saves_changes and \
+                (changed or labels_to_remove):
+            # save just the labels that changed, in one go
+            data = dict((facet_label.key, encode_items(facet_label.items))
+                        for facet_label in changed)
+            if labels_to_remove:
+                data[self.key] = self._manifest()
+            self.group.store_many(data)
+
+    def get_or_create_label(self, name, slug=None):
+        if slug is None:
+            slug = slugify(name)
+        # initialise a FacetLabel if we have to
+        if slug not in self._label_dict:
+            facet_label = self._FacetLabelClass(facet=self, name=name,
+                                                slug=slug)
+            if name in self.default_selected_slugs:
+                facet_label.is_default = True
+                facet_label.is_selected = True
+            self.writable_label_dict()[slug] = facet_label
+        return self._label_dict[slug]
+
+    def related_label_field(self, path):
+        """
+        Return the field of the related model at `path` that my labels are
+        the values of (e.g. "name", if `field` is "colours__name"), or None.
+        """
+        if self.field is None or not self.field.startswith(path + '__'):
+            return None
+        attr = self.field[len(path) + 2:]
+        if '__' in attr:
+            return None
+        return attr
+
+    def rename_label(self, old_name, new_name, inhibit_save=False):
+        """
+        Rename the label called `old_name` (e.g. when the related row it was
+        read from is renamed), merging it into the label called `new_name`
+        if there already is one. Nothing is reindexed.
+        """
+        old_slug, new_slug = slugify(old_name), slugify(new_name)
+        facet_label = self._label_dict.get(old_slug)
+        if facet_label is None or facet_label.is_all:
+            return
+        with self.group.updating():
+            for key in facet_label.items:
+                self.group.touch(key)
+            label_dict = self.writable_label_dict()
+            del label_dict[old_slug]
+            target = label_dict.get(new_slug)
+            if target is None:
+                # a new label, so that readers of the old one aren't disturbed
+                target = facet_label.copy_for(self)
+                target.name, target.slug = new_name, new_slug
+                target.is_default = target.is_selected = \
+                    new_name in self.default_selected_slugs
+                label_dict[new_slug] = target
+            else:
+                target = self.writable_label(target)
+                items = target.writable_items()
+                items |= facet_label.items
+
+            if self._item_labels is not None and old_slug != new_slug:
+                for key in facet_label.items:
+                    slugs = [slug for slug in self._item_labels.get(key, ())
+                             if slug != old_slug]
+                    if new_slug not in slugs:
+                        slugs.append(new_slug)
+                    self._item_labels[key] = tuple(slugs)
+
+            if not inhibit_save and self.group.saves_changes:
+                self.group.store_many({
+                    target.key: encode_items(target.items),
+                    self.key: self._manifest(),
+                }, delete=[facet_label.key] if old_slug != new_slug else ())
+
+    def copy_key(self, facet, key):
+        """
+        Index the item with `key` as `facet` (this facet, in another index
+        of the group) does, or unindex it if that doesn't hold it.
+        """
+        self.unindex_key(key, inhibit_save=True)
+        if not facet.group.is_indexed(key):
+            return
+        self.index_key(key, [facet._label_dict[slug].name
+                             for slug in facet.item_labels(key)],
+                       inhibit_save=True)
+
+    def writable_label_dict(self):
+        # see FacetLabel.writable_items
+        return self.group.writable(self, '_label_dict', dict)
+
+    def writable_label(self, facet_label):
+        """
+        Return `facet_label`, to change. During an update of the group, that
+        is a copy of it, which replaces it in my labels (once per update), so
+        that readers of the old label, or of my old labels, aren't disturbed.
+        """
+        copied = self.group._copied
+        if copied is None:
+            return facet_label
+        copy = copied.get((id(facet_label), None))
+        if copy is not None:
+            return copy
+        if self._label_dict.get(facet_label.slug) is not facet_label:
+            # not one of mine (any more)
+            return facet_label
+        copy = facet_label.copy_for(self)
+        self.writable_label_dict()[copy.slug] = copy
+        copied[(id(facet_label), None)] = copied[(id(copy), None)] = copy
+        # keep the old label, so its id isn't reused during the update
+        copied[(id(copy), 'replaces')] = facet_label
+        return copy
 
     def index_labels(self, facet_labels, item, inhibit_save=False):
         for label in facet_labels:
-            # initialise a FacetLabel if we have to
-            ltext = unicode(label)
-            slug = slugify(ltext)
-            if slug not in self._label_dict:
-                self._label_dict[slug] = self._FacetLabelClass(facet=self,
-                                                name=ltext, slug=slug)
-                if ltext in self.default_selected_slugs:
-                    self._label_dict[slug].is_default = True
-                    self._label_dict[slug].is_selected = True
-
-
-            self._label_dict[slug].add_item(item)
+            self.get_or_create_label(unicode(label)).add_item(item,
+                                                              inhibit_save=True)
         if not inhibit_save:
             self.save()
 
     def save(self):
-        # save all my labels (it's a no-op, but subclasses may save to storage)
-        for label in self._label_dict.values():
-            label.save()
+        # save all my labels in one go (a no-op, unless the group has storage)
+        if self.group.saves_changes:
+            self.group.store_many(self.stored_data())
+
+    def stored_data(self):
+        """
+        Return what `save` stores, by key: the items of each label, and the
+        manifest of labels.
+        """
+        data = dict((label.key, encode_items(label.items))
+                    for label in self._label_dict.values())
+        data[self.key] = self._manifest()
+        return data
+
+    def _manifest(self):
+        # the labels to create when loading the index
+        return encode_value(
+            [(label.slug, label.name) for label in self._label_dict.values()])
+
+    def stored_state(self, name):
+        """
+        Return what to store, by key, once an update has changed my attribute
+        `name` (see `FacetGroup.save_update`).
+        """
+        if name == '_label_dict':
+            return {self.key: self._manifest()}
+        return {}
+
+    def partial_index(self):
+        """
+        Return my index in a picklable form, for `merge_partial_index`: a
+        list of (label slug, label name, keys).
+        """
+        return [(facet_label.slug, facet_label.name, list(facet_label.items))
+                for facet_label in self._label_dict.values()]
+
+    def merge_partial_index(self, partial_index):
+        """
+        Add a partial index, as returned by `partial_index`, to mine. Where
+        label names differ for the same slug, mine (or the first merged)
+        wins.
+        """
+        for slug, name, keys in partial_index:
+            facet_label = self.get_or_create_label(name, slug)
+            for key in keys:
+                facet_label.add_item(key, inhibit_save=True)
+
+    def save_manifest(self):
+        self.group.store(self.key, self._manifest())
+
+    def load(self, data=None):
+        """
+        Load my labels from the group's storage, given my stored manifest if
+        it has already been retrieved. Returns False if they aren't stored.
+        """
+        if data is None:
+            data = self.group.load_stored(self.key)
+        if data is None:
+            return False
+        manifest = decode_value(data)
+        self.clear_items()
+        self._stored_slugs = set(slug for slug, name in manifest)
+        for facet_label in self._label_dict.values(): # i.e. 'all'
+            facet_label._items = facet_label.initialise_items()
+        for slug, name in manifest:
+            self.get_or_create_label(name, slug)
+        self._stored_slugs = set()
+        return True
+
+    def load_snapshot(self, snapshot):
+        """
+        Create my labels from a snapshot. Their items are read-only views of
+        it, which are only copied to change them.
+        """
+        self.clear_items()
+        for slug, name, offset, length in snapshot.facets[self.slug]:
+            facet_label = self.get_or_create_label(name, slug)
+            facet_label._items = snapshot.items(offset, length,
+                                                self.group.new_item_set)
 
     def matching_items(self):
         if self._matching_items is None:
             for facet_label in self.selected():
                 if self._matching_items is None:
-                    self._matching_items = facet_label.items.copy()
+                    self._matching_items = working_copy(facet_label.items)
                 else:
                     if self.select_multiple and self.intersect_if_multiple:
                         # take intersection of selected facet_labels
@@ -258,31 +651,225 @@ class Facet(object):
 
         return self._matching_items
 
+    def _count_bases(self):
+        # the items matched by the other facets, and the items that labels
+        # are intersected with to count them.
+        others = self.group.matching_items(ignore=[self])
+        if self.select_multiple and self.intersect_if_multiple:
+            # labels would further narrow the current selection
+            return others, self.group.matching_items()
+        return others, others
+
+    def count_label(self, facet_label):
+        """
+        Return the number of items `facet_label` would match (the length of
+        `facet_label.matching_items()`), without building them.
+        """
+        others, base = self._count_bases()
+        if facet_label.is_all:
+            return len(others)
+        return intersection_count(base, facet_label.items)
+
+    def counts(self):
+        """
+        Return {slug: count} for all my labels, worked out once per change
+        of selection (see `compute_counts`).
+        """
+        if self._counts is None:
+            self.compute_counts()
+        return self._counts
+
+    def compute_counts(self, facet_labels=None):
+        """
+        Work out the count of every label (or just fill in those of
+        `facet_labels`), intersecting each with the items matched by the
+        other facets, which is only computed once.
+        """
+        engine = self.group.get_count_engine()
+        if engine is not None:
+            # the engine counts the whole group's labels at once
+            engine.compute_counts(self.group)
+            return
+
+        others, base = self._count_bases()
+        if facet_labels is not None:
+            for facet_label in facet_labels:
+                facet_label._count = len(others) if facet_label.is_all else \
+                    intersection_count(base, facet_label.items)
+            return
+        counts = {}
+        for facet_label in self._index_labels():
+            counts[facet_label.slug] = len(others) if facet_label.is_all \
+                else intersection_count(base, facet_label.items)
+        self._counts = counts
+
+    def _index_labels(self):
+        # my labels, to read the index from: in a copy of me (see
+        # `copy_for`), the original's, so that reading doesn't copy them
+        labels = self._label_dict
+        if isinstance(labels, LabelCopies):
+            labels = labels.labels
+        return labels.values()
+
     def invalidate(self):
         self._matching_items = None
-        for facet_label in self._label_dict.values():
+        self._counts = None
+        labels = self._label_dict
+        if isinstance(labels, LabelCopies):
+            # the rest have no results of ours to forget
+            labels = labels.copies
+        for facet_label in labels.values():
             facet_label.invalidate()
 
+    def published_copy(self):
+        """
+        Return a copy of me as my index stands, for selections to be copied
+        from until the next update is published (see `FacetGroup.selection`).
+        Updates replace what they change rather than change it in place, so
+        the copy can share everything.
+        """
+        facet = object.__new__(self.__class__)
+        facet.__dict__.update(self.__dict__)
+        return facet
+
+    def copy_for(self, group, labels=True, index=None):
+        """
+        Return a copy of this facet for `group` (see `FacetGroup.selection`),
+        with the index of `index` (a `published_copy` of me), if given. If
+        `labels` is False, the copy's index is empty.
+        """
+        facet = object.__new__(self.__class__)
+        facet.__dict__.update(self.__dict__)
+        facet.group = group
+        if labels:
+            if index is not None:
+                for name in self.index_attributes:
+                    setattr(facet, name, getattr(index, name))
+            facet._source = self._source or index or self
+            facet._label_dict = LabelCopies(facet, facet._label_dict)
+            facet.labels = None
+            facet._matching_items = None
+            facet._counts = None
+        else:
+            facet._source = None
+            facet.clear_items()
+        return facet
+
     def __unicode__(self):
         return self.name
 
     def __repr__(self):
         return "<%s: %s>" % (self.__class__.__name__, self.name)
 
-    def sort(self, cmp_func=None):
-        if cmp_func is None:
-            cmp_func = self.cmp_func
+    def sort(self, cmp_func=None, sort_key=None, limit=None):
+        """
+        Sort my labels into `labels`, 'all' first, by `sort_key` (or
+        `cmp_func`; by default, my own). If there's a `limit` (by default,
+        mine), only the first that many are picked out, with a heap, and
+        sorted, plus any selected labels.
+        """
+        if sort_key is None:
+            if cmp_func is None:
+                sort_key = self.sort_key
+            else:
+                sort_key = cmp_to_key(cmp_func)
+        if limit is None:
+            limit = self.limit
+
+        if sort_key is self.sort_key and not self.sort_uses_counts:
+            # already in order, so only the labels shown are looked at
+            slugs = self.sorted_slugs()
+            if limit is not None and limit < len(slugs):
+                selected = set(facet_label.slug
+                               for facet_label in self.selected())
+                slugs = slugs[:limit] + [slug for slug in slugs[limit:]
+                                         if slug in selected]
+            facet_label = self._label_dict.get(self.all_label_slug)
+            all_labels = [facet_label] \
+                if facet_label is not None and facet_label.is_all else []
+            self.labels = all_labels + [self._label_dict[slug]
+                                        for slug in slugs]
+            return
+
+        all_labels = []
+        others = []
+        for facet_label in self._label_dict.values():
+            if facet_label.is_all:
+                all_labels.append(facet_label)
+            else:
+                others.append(facet_label)
+
+        if limit is not None and limit < len(others):
+            top = heapq.nsmallest(limit, others, key=sort_key)
+            shown = set(id(facet_label) for facet_label in top)
+            # keep selected labels, so that they can be unselected
+            top.extend(facet_label for facet_label in others
+                       if facet_label.is_selected
+                       and id(facet_label) not in shown)
+            others = top
+        others.sort(key=sort_key)
+        self.labels = all_labels + others
+
+    def sorted_slugs(self):
+        """
+        Return the slugs of my labels other than 'all', in order. Unless my
+        order depends on counts, it's only worked out once per change to the
+        index.
+        """
+        if self.sort_uses_counts:
+            labels = self._label_dict.values()
+        else:
+            # the facet I was copied from for a selection (or I) keeps it
+            source = self._source or self
+            generation = self.group.index_generation
+            order = source._label_order
+            if order is not None and order[0] == generation:
+                return order[1]
+            labels = self._index_labels()
+        ordered = sorted((facet_label for facet_label in labels
+                          if not facet_label.is_all), key=self.sort_key)
+        slugs = [facet_label.slug for facet_label in ordered]
+        # a published index doesn't change; the live one, between updates
+        if not self.sort_uses_counts and \
+                (source is not self or generation % 2 == 0):
+            source._label_order = (generation, slugs)
+        return slugs
 
-        def _sort_func(a, b):
-            if a.is_all:
-                return -1
-            if b.is_all:
-                return 1
+    @property
+    def label_total(self):
+        """
+        The number of labels (other than 'all') there are to page through.
+        """
+        if self.hide_all:
+            return len(self._label_dict)
+        return len(self._label_dict) - 1
 
-            return cmp_func(a, b)
+    def labels_page(self, offset=0, limit=None):
+        """
+        Return `limit` of my labels other than 'all' (or the rest of them),
+        from `offset`, in order, e.g. to show the long tail of a large facet
+        a page at a time (see also `label_total`).
 
-        unsorted = self._label_dict.values()
-        self.labels = sorted(unsorted, cmp=_sort_func)
+        Unless my order depends on counts, only the page's labels are
+        counted. Otherwise, only as many as are needed are picked out and
+        sorted.
+        """
+        if not self.sort_uses_counts:
+            slugs = self.sorted_slugs()
+            slugs = slugs[offset:] if limit is None else \
+                slugs[offset:offset + limit]
+            page = [self._label_dict[slug] for slug in slugs]
+            self.compute_counts([facet_label for facet_label in page
+                                 if facet_label._count is None])
+            return page
+
+        others = [facet_label for facet_label in self._label_dict.values()
+                  if not facet_label.is_all]
+        if limit is None:
+            others.sort(key=self.sort_key)
+            return others[offset:]
+        return heapq.nsmallest(offset + limit, others,
+                               key=self.sort_key)[offset:]
 
     def select_slugs(self, *slugs):
         """
@@ -304,8 +891,8 @@ class Facet(object):
 
         if not self.select_multiple or slugs == [self.all_label_slug]:
             # clear other selections
-            for v in self._label_dict:
-                self._label_dict[v].is_selected = False
+            for facet_label in self.selected():
+                facet_label.is_selected = False
 
         # make the selection
         for v in slugs:
@@ -344,11 +931,13 @@ class Facet(object):
             self._select_default()
 
     def clear_selection(self):
-        for v in self._label_dict:
-            self._label_dict[v].is_selected = False
+        for facet_label in self.selected():
+            facet_label.is_selected = False
         self._select_default()
 
     def selected(self):
+        if isinstance(self._label_dict, LabelCopies):
+            return self._label_dict.selected()
         return filter(lambda x: x.is_selected, self._label_dict.values())
 
 
@@ -358,12 +947,55 @@ class FacetGroup(object):
     """
 
     app_label = None
+    # set to True to store label items as bitmaps of dense integer ids,
+    # rather than as sets of items.
+    use_bitmaps = False
+    # set to a count engine class (e.g.
+    # facettools.numpy_engine.NumpyCountEngine) to work out label counts
+    # from its own copy of the index, rather than with item set arithmetic.
+    count_engine = None
+    # a storage backend (see facettools.storage) that rebuild_index saves the
+    # index to, so that other processes can load_index() it instead.
+    storage = None
+    # change this when facets change, so that indexes stored by older code
+    # are ignored.
+    storage_version = 1
 
     def __init__(self):
-        self._matching_items = None
+        # the items matching the current selection, keyed by the (frozen)
+        # set of slugs of the facets ignored in working them out.
+        self._matching_items = {}
         self.is_filtered = False
+        self.item_registry = ItemRegistry()
+        self._count_engine = None
+        # held while the count engine is built, so that it's built once per
+        # change to the index, and shared by selections
+        self._engine_lock = threading.Lock()
+        # the group that this one is a selection of (see `selection`)
+        self._source = None
+        # the generation of the stored index that we save to
+        self.storage_generation = None
+        # stored data fetched in bulk by load_index, by storage key
+        self._preloaded = None
+        # held while the index is swapped (see `swap_index`) or copied, so
+        # copies never mix two indexes.
+        self._index_lock = threading.Lock()
+        # held while the index is changed (see `updating`), so that changes
+        # are made one at a time.
+        self._write_lock = threading.RLock()
+        self._update_depth = 0
+        # (id, attribute name) -> object, for each attribute the current
+        # update has copied, or None if we aren't copying.
+        self._copied = None
+        # incremented when an update starts and ends, so it is odd while one
+        # is being made.
+        self.index_generation = 0
+        # the keys of the items changed while a new index is being built to
+        # swap in, or None (see `touch`)
+        self._touched = None
         self.facets = SortedDict()
         self.declare_facets()
+        self._publish()
         if self.app_label is None:
             model_module = sys.modules[self.__class__.__module__]
             self.app_label = model_module.__name__.split('.')[-2]
@@ -392,47 +1024,391 @@ class FacetGroup(object):
         """
         return self.facets.values().__iter__()
     
-    def rebuild_index(self):
+    def rebuild_index(self, swap=True):
         """
         Bulk update to rebuild index
         1. erase old index
-        2. iterate through unfiltered_collection
+        2. iterate through unfiltered_collection (see `index_collection`)
             add it to 'all' for each defined facet
             call get_FOO_facet for each defined facet
             update facet labels with the result
         3. save facet labels to the index
         4. update facets
+
+        The old index isn't erased: the new one is built alongside it, and
+        swapped in once it is complete (see `build_and_swap`), so that
+        requests served meanwhile see the whole old index, without waiting,
+        and changes made to it meanwhile are carried over. That
+        takes memory for both; with swap=False, the old index is erased and
+        the new one built in its place, and selections wait for it.
         """
-        self.clear_items()
-        for item in self.unfiltered_collection():
-            self.index_item(item, inhibit_save=True)
+        if swap:
+            self.build_and_swap(lambda new_index:
+                                new_index.rebuild_index(swap=False))
+            return
+        # selections wait for the new index, rather than copy a partial one
+        with self.updating(copy=False):
+            self.clear_items()
+            self.index_collection()
+        self._finish_rebuild()
+
+    def _finish_rebuild(self):
+        self.save_index()
+        if self.count_engine is not None:
+            self._build_count_engine()
+        self.update()
+
+    def storage_key(self, key, generation=None):
+        """
+        Return the storage key for a facet or label `key`, in the given
+        generation of the stored index (by default, the current one).
+        """
+        return "facettools:v%s:%s:%s" % (self.storage_version,
+            generation or self.storage_generation, key)
+
+    def _generation_key(self):
+        # where the current generation of the stored index is recorded
+        return "facettools:v%s:%s" % (self.storage_version, self.key)
+
+    @property
+    def saves_changes(self):
+        """
+        Whether changes to the index are saved, i.e. we have storage, and a
+        stored index to save them to. Check it before encoding what to save.
+        """
+        return self.storage is not None and self.storage_generation is not None
+
+    def store(self, key, data):
+        """
+        Save `data` for a facet or label `key`, if we have storage. `data`
+        may be a function that returns it, which is only called if so.
+        """
+        if self.saves_changes:
+            if callable(data):
+                data = data()
+            self.storage.set(self.storage_key(key), data)
+
+    def store_many(self, data, delete=()):
+        """
+        Save a dict of facet or label keys to data in one batch, if we have
+        storage, and delete the keys in `delete` (e.g. of removed labels).
+        As with `store`, each value may be a function returning it.
+        """
+        if self.saves_changes:
+            self.storage.set_many(dict(
+                (self.storage_key(key), value() if callable(value) else value)
+                for key, value in data.items()
+            ))
+            if delete:
+                self.storage.delete_many([self.storage_key(key)
+                                          for key in delete])
+
+    def load_stored(self, key):
+        if self.saves_changes:
+            storage_key = self.storage_key(key)
+            if self._preloaded is not None:
+                # load_index has already fetched everything
+                return self._preloaded.get(storage_key)
+            return self.storage.get(storage_key)
+        return None
+
+    def save_index(self):
+        """
+        Save the whole index to storage (if any) as a new generation, then
+        make that the generation that load_index() loads, and delete the
+        previous one.
+        """
+        if self.storage is None:
+            return
+        old_generation = self.storage.get(self._generation_key())
+        self.storage_generation = uuid.uuid4().hex
+        data = {}
         for facet in self:
-            facet.save()
+            data.update(facet.stored_data())
+        self.store_many(data)
+        self.storage.set(self._generation_key(), self.storage_generation)
+        if old_generation is not None:
+            self._delete_generation(old_generation)
+
+    def _delete_generation(self, generation):
+        facet_keys = dict((self.storage_key(facet.key, generation), facet)
+                          for facet in self)
+        keys = facet_keys.keys()
+        for facet_key, data in self.storage.get_many(keys).items():
+            facet = facet_keys[facet_key]
+            for slug, name in decode_value(data):
+                keys.append(self.storage_key("%s__%s" % (facet.key, slug),
+                                             generation))
+        self.storage.delete_many(keys)
+
+    def load_index(self):
+        """
+        Load the index that was last saved to storage, which is much quicker
+        than rebuilding it. Returns False, leaving the index empty, if there
+        isn't one (in which case you'll want to rebuild_index).
+        """
+        if self.storage is None:
+            return False
+        generation = self.storage.get(self._generation_key())
+        if generation is None:
+            return False
+        with self.updating(copy=False):
+            self.clear_items()
+            self.storage_generation = generation
+
+            # fetch the manifests, then all the labels, in a batch each
+            manifests = self.storage.get_many(
+                [self.storage_key(facet.key) for facet in self])
+            label_keys = []
+            for facet in self:
+                data = manifests.get(self.storage_key(facet.key))
+                if data is None:
+                    self.storage_generation = None
+                    return False
+                label_keys.extend(
+                    self.storage_key("%s__%s" % (facet.key, slug))
+                    for slug, name in decode_value(data))
+            self._preloaded = self.storage.get_many(label_keys)
+            if len(self._preloaded) < len(set(label_keys)):
+                # a label is missing (e.g. evicted from a cache), so the
+                # stored index is incomplete
+                self._preloaded = None
+                self.storage_generation = None
+                return False
+            try:
+                for facet in self:
+                    facet.load(manifests[self.storage_key(facet.key)])
+            finally:
+                self._preloaded = None
+        if self.count_engine is not None:
+            self._build_count_engine()
+        self.update()
+        return True
+
+    def write_snapshot(self, path):
+        """
+        Write the index to a binary snapshot file, for load_snapshot. The
+        items must be indexed by integer keys (e.g. with index_pks).
+        """
+        write_snapshot(self, path)
+
+    def load_snapshot(self, path):
+        """
+        Load the index from a snapshot file. The file is memory-mapped, and
+        labels' items are read in place, so processes that load it share its
+        pages (until they change labels, which copies them).
+
+        Returns False, leaving the index alone, if there's no snapshot at
+        `path`, or it is stale (written by another version of facettools,
+        or for another `storage_version` of this group).
+        """
+        snapshot = Snapshot.open(path, self)
+        if snapshot is None:
+            return False
+        with self.updating(copy=False):
+            self.clear_items()
+            for facet in self:
+                facet.load_snapshot(snapshot)
+        if self.count_engine is not None:
+            self._build_count_engine()
         self.update()
+        return True
+
+    def load_or_write_snapshot(self, path):
+        """
+        Load the index from the snapshot at `path` if there's a current one,
+        otherwise rebuild the index and write a new snapshot.
+        """
+        if not self.load_snapshot(path):
+            self.rebuild_index()
+            self.write_snapshot(path)
+
+    def item_key(self, item):
+        """
+        Return what the index stores for `item`. By default that is the item
+        itself, so `matching_items` returns items; subclasses may return a
+        smaller key (e.g. a primary key) to keep the index compact.
+        """
+        return item
+
+    def new_item_set(self):
+        """
+        Return an empty container for the items of a label.
+        """
+        if self.use_bitmaps:
+            return ItemBitmap(self.item_registry)
+        return ChunkedItemSet()
+
+    def index_collection(self, collection=None):
+        """
+        Index every item of `collection` (by default, the unfiltered
+        collection), without saving.
+        """
+        if collection is None:
+            collection = self.iter_collection()
+        for item in collection:
+            self.index_item(item, inhibit_save=True)
+
+    def iter_collection(self):
+        """
+        Iterate over the items to index. Subclasses may stream them in
+        chunks, to bound memory.
+        """
+        return iter(self.unfiltered_collection())
 
     def clear_items(self):
         """
-        Subclasses that implement storage may wish to purge the storage to
-        avoid orphans.
+        Clear the index in memory. The stored index (if any) is replaced
+        when the index is next saved.
         """
+        self.item_registry = ItemRegistry()
+        self._count_engine = None
         for facet in self:
             facet.clear_items()
 
     def index_item(self, item, inhibit_save=False):
-        for facet in self:
-            facet.index_item(item, inhibit_save)
+        with self.updating():
+            for facet in self:
+                facet.index_item(item, inhibit_save)
 
     def unindex_item(self, item, inhibit_save=False):
+        self.unindex_key(self.item_key(item), inhibit_save)
+
+    def unindex_key(self, key, inhibit_save=False):
+        with self.updating():
+            for facet in self:
+                facet.unindex_key(key, inhibit_save)
+
+    @contextmanager
+    def updating(self, copy=True):
+        """
+        Change the live index within this block (as `index_item` and
+        `unindex_item` do), while other threads read it.
+
+        Updates are made one at a time. Each copies the labels, label sets
+        and dicts it changes, rather than changing them in place, so that
+        readers never see them change under them. Label sets are
+        `ChunkedItemSet`s (unless `use_bitmaps`), whose copies share all but
+        the chunks that change, so that's cheap even for large labels.
+
+        Nothing an update changes is seen by `selection()` until it ends,
+        when the index as it then stands is published in one step, so
+        reading the index never waits for an update, however long.
+
+        Pass copy=False to change the index in place, e.g. when it has just
+        been cleared.
+        """
+        with self._write_lock:
+            self._update_depth += 1
+            if self._update_depth == 1:
+                self.index_generation += 1
+                if copy:
+                    self._copied = {}
+            try:
+                yield
+            finally:
+                self._update_depth -= 1
+                if not self._update_depth:
+                    self._copied = None
+                    self.index_generation += 1
+                    self._count_engine = None
+                    self._publish()
+
+    def _publish(self):
+        # make the index as it stands the one that selections copy
+        facets = SortedDict()
+        for slug, facet in self.facets.items():
+            facets[slug] = facet.published_copy()
+        self._published = (self.index_generation, facets, self.item_registry)
+
+    def save_update(self):
+        """
+        Save everything the current update has changed so far (the labels,
+        and the manifests of facets whose labels were added or removed), in
+        one batch. Use it after changes made with inhibit_save.
+        """
+        if not self._copied or not self.saves_changes:
+            return
+        data = {}
+        for (i, name), obj in self._copied.items():
+            if isinstance(obj, Facet):
+                data.update(obj.stored_state(name))
+            elif obj.facet._label_dict.get(obj.slug) is obj: # not removed
+                data[obj.key] = encode_items(obj.items)
+        self.store_many(data)
+
+    def writable(self, obj, name, copy):
+        """
+        Return the value of `obj`'s attribute `name`, to change in place.
+        During an update, it is first replaced with `copy(value)` (once per
+        update), so that readers of the old value aren't disturbed.
+        """
+        value = getattr(obj, name)
+        copied = self._copied
+        if copied is not None and (id(obj), name) not in copied:
+            value = copy(value)
+            setattr(obj, name, value)
+            # keep obj, so its id isn't reused during the update
+            copied[(id(obj), name)] = obj
+        return value
+
+    def is_indexed(self, key):
+        """
+        Return whether the item with `key` is in the index.
+        """
         for facet in self:
-            facet.unindex_item(item, inhibit_save)
+            if not facet.hide_all:
+                return key in facet[facet.all_label_slug].items
+        return any(facet.item_labels(key) for facet in self)
+
+    def get_count_engine(self):
+        """
+        Return the count engine, (re)building it if the index has changed
+        since it was last built, or None if `count_engine` isn't set.
+
+        It's built once per change to the index, by whichever thread needs
+        it first, and selections share the group's engine (unless the index
+        has changed since they were made).
+        """
+        if self.count_engine is None:
+            return None
+        engine = self._count_engine
+        if engine is not None and \
+                engine.index_generation == self.index_generation:
+            return engine
+        group = self._source or self
+        with group._engine_lock:
+            engine = group._count_engine
+            if engine is None or \
+                    engine.index_generation != self.index_generation:
+                engine = self._build_count_engine()
+                # for the next selection of the same index
+                group._count_engine = engine
+        self._count_engine = engine
+        return engine
+
+    def _build_count_engine(self):
+        generation = self.index_generation
+        engine = self.count_engine(self)
+        if self.index_generation != generation:
+            # an update was made meanwhile, and may be half in the engine
+            generation = None
+        engine.index_generation = generation
+        self._count_engine = engine
+        return engine
 
     def matching_items(self, ignore=[]):
         """
         Take the intersection of the items that match each facet.
+
+        Results are cached until the next `invalidate()`, so that every label
+        of a facet shares the intersection of all the other facets.
         """
-        if ignore == []:
-            if self._matching_items is not None:
-                return self._matching_items
+        cache_key = frozenset(facet.slug for facet in ignore)
+        try:
+            return self._matching_items[cache_key]
+        except KeyError:
+            pass
 
         mi = None
         for facet in self:
@@ -444,15 +1420,13 @@ class FacetGroup(object):
                     else:
                         mi &= fmi
         if mi is None:
-            mi = set()
-
-        if ignore == []:
-            self._matching_items = mi
+            mi = self.new_item_set()
 
+        self._matching_items[cache_key] = mi
         return mi
 
     def invalidate(self):
-        self._matching_items = None
+        self._matching_items = {}
         for facet in self:
             facet.invalidate()
 
@@ -472,6 +1446,132 @@ class FacetGroup(object):
         for facet in self:
             facet.clear_selection()
 
+    def empty_copy(self):
+        """
+        Return a copy of this group with an empty index of its own, to build
+        a new index in while this one stays live.
+        """
+        group = object.__new__(self.__class__)
+        with self._index_lock:
+            group.__dict__.update(self.__dict__)
+        # it has its own locks, so that building it doesn't hold up updates
+        # of this index
+        group._index_lock = threading.Lock()
+        group._write_lock = threading.RLock()
+        group._update_depth = 0
+        group._copied = None
+        group.item_registry = ItemRegistry()
+        group._count_engine = None
+        group._engine_lock = threading.Lock()
+        group._touched = None
+        facets = group.facets
+        group.facets = SortedDict()
+        for slug, facet in facets.items():
+            group.facets[slug] = facet.copy_for(group, labels=False)
+        group._matching_items = {}
+        group.is_filtered = False
+        group._publish()
+        return group
+
+    def build_and_swap(self, build):
+        """
+        Build a new index with `build(new_index)`, in an `empty_copy`, and
+        swap it in. Items changed in this index meanwhile (e.g. by signal
+        handlers) are brought up to date in the new one first (see
+        `catch_up`), so that their changes aren't lost.
+        """
+        with self._write_lock:
+            self._touched = set()
+        try:
+            new_index = self.empty_copy()
+            build(new_index)
+            with self._write_lock:
+                if self._touched:
+                    self.catch_up(new_index, self._touched)
+                self.swap_index(new_index)
+        finally:
+            self._touched = None
+
+    def touch(self, key):
+        """
+        Note that the item with `key` is being changed, if a new index is
+        being built meanwhile (see `build_and_swap`).
+        """
+        if self._touched is not None:
+            self._touched.add(key)
+
+    def catch_up(self, new_index, keys):
+        """
+        Bring the items with `keys` up to date in `new_index`, which was
+        built while they changed in this one. By default they're copied from
+        this index; subclasses that can reindex them from their source (as
+        ModelFacetGroup does) may do that instead.
+        """
+        with new_index.updating():
+            for facet in self:
+                new_facet = new_index.facets[facet.slug]
+                for key in keys:
+                    new_facet.copy_key(facet, key)
+            new_index.save_update()
+
+    def swap_index(self, new_index):
+        """
+        Replace this group's index with that of `new_index` (built in an
+        `empty_copy`) in one step. Selections made before the swap keep
+        using the old index, which is freed once the last of them is done.
+        """
+        # the new facets (and their labels) answer to us from now on; nobody
+        # else can see them yet.
+        for facet in new_index:
+            facet.group = self
+        state = dict(new_index.__dict__)
+        for name in ('_index_lock', '_write_lock', '_engine_lock',
+                     '_update_depth', '_copied', 'index_generation',
+                     '_touched', '_published'):
+            del state[name]
+        with self._write_lock:
+            with self._index_lock:
+                self.index_generation += 2
+                if new_index._count_engine is not None:
+                    new_index._count_engine.group = self
+                    new_index._count_engine.index_generation = \
+                        self.index_generation
+                self.__dict__.update(state)
+                self._publish()
+
+    def selection(self, request=None):
+        """
+        Return a copy of this group that shares its index, but has its own
+        selections and cached results. Build the index once, and make a
+        selection for each request: threads can then query the same index
+        at once, without rebuilding it or disturbing each other's state.
+
+        If `request` is given, it is applied to the selection.
+        """
+        selection = object.__new__(self.__class__)
+        selection.__dict__.update(self.__dict__)
+        if self._source is None:
+            # the index as the last update left it, without waiting for one
+            # being made
+            selection.index_generation, index, selection.item_registry = \
+                self._published
+            selection._source = self
+        else:
+            # a selection's index doesn't change
+            index = {}
+        selection.facets = SortedDict()
+        for slug, facet in self.facets.items():
+            selection.facets[slug] = facet.copy_for(selection,
+                                                    index=index.get(slug))
+        selection._update_depth = 0
+        selection._copied = None
+        selection._matching_items = {}
+        selection.is_filtered = False
+        if request is not None:
+            selection.apply_request(request)
+        selection.update()
+        return selection
+
     def apply_request(self, request):
         # Parse a request to select the facets within it.
         self.clear_selection()
@@ -0,0 +1,214 @@
+"""
+Bitmap storage for facet label items.
+
+Items are given dense integer ids by an `ItemRegistry`, and a set of items is
+stored as a bitmap of those ids. Intersections, unions and counts then become
+word-level operations on python longs, rather than hashing every item.
+"""
+
+# ids are split into chunks of 2**16 bits, as in Roaring bitmaps, so that
+# sparse labels don't pay for the empty ranges between their items.
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def popcount(x):
+    return bin(x).count('1')
+
+
+class ItemRegistry(object):
+    """
+    Assigns a dense integer id to every item it is given. Ids are never
+    reused; a fresh registry is made whenever the index is cleared.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._items = []
+
+    def id_for(self, item):
+        """
+        Return the id of `item`, registering it if it is new.
+        """
+        try:
+            return self._ids[item]
+        except KeyError:
+            i = self._ids[item] = len(self._items)
+            self._items.append(item)
+            return i
+
+    def get_id(self, item):
+        """
+        Return the id of `item`, or None if it has never been registered.
+        """
+        return self._ids.get(item)
+
+    def item_for(self, i):
+        return self._items[i]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ItemBitmap(object):
+    """
+    A set of items, stored as a bitmap of their registry ids.
+
+    Supports the subset of the `set` API that facettools uses, so it can be
+    swapped in for the default set-of-items storage.
+    """
+    __slots__ = ('registry', '_chunks')
+
+    def __init__(self, registry, items=None):
+        self.registry = registry
+        # high bits of the id -> long with one bit set per low bits
+        self._chunks = {}
+        if items is not None:
+            for item in items:
+                self.add(item)
+
+    @classmethod
+    def from_ids(cls, registry, ids):
+        bitmap = cls(registry)
+        for i in ids:
+            bitmap.add_id(i)
+        return bitmap
+
+    def add_id(self, i):
+        hi = i >> CHUNK_BITS
+        self._chunks[hi] = self._chunks.get(hi, 0) | (1 << (i & CHUNK_MASK))
+
+    def add(self, item):
+        self.add_id(self.registry.id_for(item))
+
+    def discard_id(self, i):
+        hi = i >> CHUNK_BITS
+        chunk = self._chunks.get(hi)
+        if chunk:
+            chunk &= ~(1 << (i & CHUNK_MASK))
+            if chunk:
+                self._chunks[hi] = chunk
+            else:
+                del self._chunks[hi]
+
+    def discard(self, item):
+        i = self.registry.get_id(item)
+        if i is not None:
+            self.discard_id(i)
+
+    def has_id(self, i):
+        return bool(self._chunks.get(i >> CHUNK_BITS, 0) >> (i & CHUNK_MASK)
+                    & 1)
+
+    def __contains__(self, item):
+        i = self.registry.get_id(item)
+        return i is not None and self.has_id(i)
+
+    def ids(self):
+        """
+        Yield the ids in this bitmap, in ascending order.
+        """
+        for hi in sorted(self._chunks):
+            base = hi << CHUNK_BITS
+            # binary digits, least significant first
+            bits = bin(self._chunks[hi])[:1:-1]
+            i = bits.find('1')
+            while i != -1:
+                yield base + i
+                i = bits.find('1', i + 1)
+
+    def __iter__(self):
+        item_for = self.registry.item_for
+        for i in self.ids():
+            yield item_for(i)
+
+    def __len__(self):
+        return sum(popcount(c) for c in self._chunks.itervalues())
+
+    def __nonzero__(self):
+        return bool(self._chunks)
+
+    def intersection_count(self, other):
+        """
+        Return len(self & other), without building the intersection.
+        """
+        chunks = self._chunks
+        other = self._coerce(other)._chunks
+        if len(other) < len(chunks):
+            chunks, other = other, chunks
+        return sum(popcount(chunk & other[hi])
+                   for hi, chunk in chunks.iteritems() if hi in other)
+
+    def copy(self):
+        result = ItemBitmap(self.registry)
+        result._chunks = self._chunks.copy()
+        return result
+
+    def _coerce(self, other):
+        if isinstance(other, ItemBitmap):
+            if other.registry is not self.registry:
+                raise ValueError("Can't combine bitmaps from different "
+                                 "registries")
+            return other
+        return ItemBitmap(self.registry, other)
+
+    def __iand__(self, other):
+        other = self._coerce(other)._chunks
+        chunks = self._chunks
+        for hi in chunks.keys():
+            chunk = chunks[hi] & other.get(hi, 0)
+            if chunk:
+                chunks[hi] = chunk
+            else:
+                del chunks[hi]
+        return self
+
+    def __ior__(self, other):
+        other = self._coerce(other)._chunks
+        chunks = self._chunks
+        for hi, chunk in other.iteritems():
+            chunks[hi] = chunks.get(hi, 0) | chunk
+        return self
+
+    def __isub__(self, other):
+        other = self._coerce(other)._chunks
+        chunks = self._chunks
+        for hi in chunks.keys():
+            if hi in other:
+                chunk = chunks[hi] & ~other[hi]
+                if chunk:
+                    chunks[hi] = chunk
+                else:
+                    del chunks[hi]
+        return self
+
+    def __and__(self, other):
+        result = self.copy()
+        result &= other
+        return result
+
+    def __or__(self, other):
+        result = self.copy()
+        result |= other
+        return result
+
+    def __sub__(self, other):
+        result = self.copy()
+        result -= other
+        return result
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def __eq__(self, other):
+        if not isinstance(other, ItemBitmap):
+            return False
+        return self._chunks == other._chunks
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s: %s items>" % (self.__class__.__name__, len(self))
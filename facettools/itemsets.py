@@ -0,0 +1,287 @@
+"""
+Sets of label items that are cheap to copy.
+
+An update copies each label set it changes, rather than changing it in place
+(see FacetGroup.updating), so a plain set would cost a copy of every item of
+a large label (e.g. 'all') for every change to a few of them. A
+`ChunkedItemSet` is split by hash into chunks, which copies share until they
+change them, so an update only copies the chunks of the items it changes.
+A `ChunkedItemDict` does the same for a dict of items' values (see
+facettools.ranges).
+"""
+from itertools import chain, imap
+
+# a set's chunks are split in two once they hold more items than this, on
+# average
+CHUNK_SIZE = 1024
+
+
+class ChunkedItemSet(object):
+    """
+    A set of items, split by hash into a power of two of plain sets.
+
+    Supports the subset of the `set` API that facettools uses, so it can be
+    used for the default set-of-items storage. Intersections and unions
+    return plain sets.
+    """
+    __slots__ = ('_chunks', '_mask', '_len', '_owned')
+
+    def __init__(self, items=None):
+        self._chunks = [set()]
+        self._mask = 0
+        self._len = 0
+        # the indexes of the chunks that aren't shared with a copy, or None
+        # if none are
+        self._owned = None
+        if items is not None:
+            for item in items:
+                self.add(item)
+
+    def to_set(self):
+        """
+        Return my items as a plain set.
+        """
+        return set().union(*self._chunks)
+
+    def _writable_chunk(self, i):
+        owned = self._owned
+        if owned is not None and i not in owned:
+            self._chunks[i] = set(self._chunks[i])
+            owned.add(i)
+            if len(owned) == len(self._chunks):
+                self._owned = None
+        return self._chunks[i]
+
+    def _split(self):
+        # double the number of chunks: the items of chunk i (whose hashes
+        # end in i) go to chunks i and i + n.
+        n = len(self._chunks)
+        chunks = self._chunks + [None] * n
+        for i in xrange(n):
+            chunk = self._chunks[i]
+            high = set(item for item in chunk if hash(item) & n)
+            chunks[i] = chunk - high
+            chunks[i + n] = high
+        self._chunks = chunks
+        self._mask = 2 * n - 1
+        self._owned = None
+
+    def add(self, item):
+        i = hash(item) & self._mask
+        if item not in self._chunks[i]:
+            self._writable_chunk(i).add(item)
+            self._len += 1
+            if self._len > CHUNK_SIZE * len(self._chunks):
+                self._split()
+
+    def discard(self, item):
+        i = hash(item) & self._mask
+        if item in self._chunks[i]:
+            self._writable_chunk(i).discard(item)
+            self._len -= 1
+
+    def __contains__(self, item):
+        return item in self._chunks[hash(item) & self._mask]
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def copy(self):
+        """
+        Return a copy that shares my chunks, until either of us changes them.
+        """
+        result = ChunkedItemSet.__new__(ChunkedItemSet)
+        result._chunks = list(self._chunks)
+        result._mask = self._mask
+        result._len = self._len
+        result._owned = set()
+        self._owned = set()
+        return result
+
+    def intersection_count(self, other):
+        """
+        Return len(self & other), without building the intersection.
+        """
+        if isinstance(other, ChunkedItemSet) and other._mask == self._mask:
+            return sum(len(a & b) for a, b in zip(self._chunks, other._chunks))
+        if isinstance(other, (set, frozenset)):
+            return sum(len(chunk & other) for chunk in self._chunks)
+        if len(other) < self._len:
+            return sum(imap(self.__contains__, other))
+        return sum(imap(other.__contains__, self))
+
+    def __and__(self, other):
+        result = set()
+        if isinstance(other, ChunkedItemSet) and other._mask == self._mask:
+            for a, b in zip(self._chunks, other._chunks):
+                result |= a & b
+        elif isinstance(other, (set, frozenset)):
+            for chunk in self._chunks:
+                result |= chunk & other
+        elif len(other) < self._len:
+            result.update(item for item in other if item in self)
+        else:
+            result.update(item for item in self if item in other)
+        return result
+
+    def __or__(self, other):
+        result = self.to_set()
+        result.update(other)
+        return result
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def __iand__(self, other):
+        return self & other
+
+    def __ior__(self, other):
+        for item in other:
+            self.add(item)
+        return self
+
+    def __eq__(self, other):
+        try:
+            return len(other) == self._len and \
+                all(imap(other.__contains__, self))
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s: %s items>" % (self.__class__.__name__, self._len)
+
+
+class ChunkedItemDict(object):
+    """
+    A dict of item keys to values, split by hash into a power of two of
+    plain dicts, like a ChunkedItemSet.
+
+    Supports the subset of the `dict` API that facettools uses. Its chunks
+    can be stored separately, so that saving a change only stores the
+    chunks it changed (see `changed_chunks`).
+    """
+    __slots__ = ('_chunks', '_mask', '_len', '_owned')
+
+    def __init__(self, items=(), n_chunks=1):
+        self._chunks = [{} for i in xrange(n_chunks)]
+        self._mask = n_chunks - 1
+        self._len = 0
+        # the indexes of the chunks that aren't shared with a copy, or None
+        # if none are
+        self._owned = None
+        for key, value in items:
+            self[key] = value
+
+    def chunks(self):
+        """
+        Return my chunks, which mustn't be changed.
+        """
+        return self._chunks
+
+    def changed_chunks(self):
+        """
+        Return the indexes of the chunks I've changed since I was copied (or
+        of all of them, if I wasn't, or have been split since).
+        """
+        if self._owned is None:
+            return range(len(self._chunks))
+        return sorted(self._owned)
+
+    def _writable_chunk(self, i):
+        owned = self._owned
+        if owned is not None and i not in owned:
+            self._chunks[i] = dict(self._chunks[i])
+            owned.add(i)
+        return self._chunks[i]
+
+    def _split(self):
+        # double the number of chunks, as ChunkedItemSet does
+        n = len(self._chunks)
+        chunks = self._chunks + [None] * n
+        for i in xrange(n):
+            chunk = self._chunks[i]
+            chunks[i] = {}
+            chunks[i + n] = {}
+            for key, value in chunk.iteritems():
+                chunks[i + (hash(key) & n)][key] = value
+        self._chunks = chunks
+        self._mask = 2 * n - 1
+        self._owned = None
+
+    def __setitem__(self, key, value):
+        i = hash(key) & self._mask
+        if key not in self._chunks[i]:
+            self._len += 1
+        self._writable_chunk(i)[key] = value
+        if self._len > CHUNK_SIZE * len(self._chunks):
+            self._split()
+
+    def pop(self, key):
+        i = hash(key) & self._mask
+        value = self._writable_chunk(i).pop(key)
+        self._len -= 1
+        return value
+
+    def __getitem__(self, key):
+        return self._chunks[hash(key) & self._mask][key]
+
+    def get(self, key, default=None):
+        return self._chunks[hash(key) & self._mask].get(key, default)
+
+    def __contains__(self, key):
+        return key in self._chunks[hash(key) & self._mask]
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def iteritems(self):
+        return chain.from_iterable(chunk.iteritems() for chunk in self._chunks)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def copy(self):
+        """
+        Return a copy that shares my chunks, until either of us changes them.
+        """
+        result = ChunkedItemDict.__new__(ChunkedItemDict)
+        result._chunks = list(self._chunks)
+        result._mask = self._mask
+        result._len = self._len
+        result._owned = set()
+        self._owned = set()
+        return result
+
+    def __repr__(self):
+        return "<%s: %s items>" % (self.__class__.__name__, self._len)
+
+
+def working_copy(items):
+    """
+    Return a copy of a label's items to work a result out in, such as the
+    items matching a selection. A result is read rather than copied, so it's
+    a plain set rather than a ChunkedItemSet.
+    """
+    if isinstance(items, ChunkedItemSet):
+        return items.to_set()
+    result = items.copy()
+    if isinstance(result, ChunkedItemSet):
+        result = result.to_set()
+    return result
@@ -0,0 +1,16 @@
+from .model_base import flush_deferred
+
+
+class FacetIndexMiddleware(object):
+    """
+    Applies the index changes queued while handling each request, by groups
+    with `defer_indexing`, in one batch per group.
+
+    List it before django.middleware.transaction.TransactionMiddleware, so
+    that it runs once the request's transaction has been committed or
+    rolled back. Not needed with Django's transaction.on_commit.
+    """
+
+    def process_response(self, request, response):
+        flush_deferred()
+        return response
@@ -1,11 +1,55 @@
+import multiprocessing
+import threading
+import weakref
+from contextlib import contextmanager
+
+from django.core.exceptions import FieldError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query_utils import Q
-from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db.models.signals import post_delete, post_init, post_save, \
+    pre_delete, pre_save
+from django.template.defaultfilters import slugify
 try:
     from django.db.models.signals import m2m_changed
 except ImportError:
     m2m_changed = None
 
 from .base import FacetGroup
+from .storage import batches
+from .worker import IndexingWorker
+
+# groups that defer indexing, and watch a model (see `flush_deferred`)
+deferring_groups = weakref.WeakSet()
+
+# a field value that hasn't been loaded (e.g. a deferred field)
+NOT_LOADED = object()
+
+
+def flush_deferred():
+    """
+    Apply the index changes that signal handlers have queued in this
+    thread, for every group that defers indexing.
+    """
+    for group in list(deferring_groups):
+        group.flush()
+
+
+def index_pk_range(args):
+    """
+    Index the items of a FacetGroup class with pks from `lo` to `hi`
+    (inclusive). Run in worker processes by
+    `ModelFacetGroup.rebuild_index_parallel`.
+
+    Returns the partial index: for each facet slug, its
+    `Facet.partial_index()`.
+    """
+    group_class, lo, hi = args
+    group = group_class()
+    group.clear_items()
+    group.index_collection(
+        group.unfiltered_collection().filter(pk__gte=lo, pk__lte=hi))
+    return dict((facet.slug, facet.partial_index()) for facet in group)
 
 
 class ModelFacetGroup(FacetGroup):
@@ -13,50 +57,643 @@ class ModelFacetGroup(FacetGroup):
     A Facetgroup that knows about model CRUD operations
     """
 
+    # set to True to index primary keys rather than model instances, so that
+    # instances can be garbage-collected once they have been indexed.
+    # matching_items() then returns pks.
+    index_pks = False
+    # rebuild_index loads the collection this many rows at a time
+    chunk_size = 1000
+    # set to True to have signal handlers queue the pks of changed items,
+    # rather than reindex them there and then. Queued pks are reindexed in
+    # one batch when the transaction commits (with Django's
+    # transaction.on_commit, where there is one), or else by
+    # facettools.middleware.FacetIndexMiddleware, or a call to `flush()`.
+    defer_indexing = False
+    # the facettools.worker.IndexingWorker that reindexes flushed pks, if
+    # any (see `watch_model`)
+    worker = None
+    # the fields (or relations) of the model that unfiltered_collection
+    # filters on, e.g. ("is_archived",). If they are given, saves that change
+    # neither these nor any facet's `depends_on` don't touch the index.
+    collection_depends_on = None
+
+    def __init__(self, *args, **kwargs):
+        super(ModelFacetGroup, self).__init__(*args, **kwargs)
+        # the pks queued in each thread, as transactions are per thread
+        self._queued = threading.local()
+        # see `tracked_fields`; instances keep their tracked values in an
+        # attribute of their own for each group.
+        self._tracked_fields = {}
+        self._clean_attr = '_facettools_clean_%x' % id(self)
+        # through model -> the ManyToManyField, for the models we watch
+        self._m2m_fields = {}
+        self._watched = set()
+
+    def item_key(self, item):
+        if self.index_pks:
+            return item.pk
+        return item
+
     @property
     def model(self):
         return self.unfiltered_collection().model
 
-    def watch_model(self, model):
-        pre_save.connect(self.pre_save, sender=model)
+    def index_collection(self, queryset=None, facets=None):
+        """
+        Index the items of `queryset` (by default, the unfiltered
+        collection), in `facets` (by default, all of them).
+
+        Facets that declare a `field` are indexed from one values_list query
+        each, rather than by following the path from every item. If they all
+        do, and we index pks, the items aren't loaded at all. Paths that
+        aren't lookups (e.g. that end in a property) are followed from every
+        item.
+        """
+        if queryset is None:
+            queryset = self.unfiltered_collection()
+        if facets is None:
+            facets = list(self)
+        collection = queryset.order_by()
+        field_labels = {}
+        for facet in facets:
+            if facet.field is not None:
+                try:
+                    values = collection.values_list('pk', facet.field)
+                except FieldError:
+                    continue
+                labels = field_labels[facet.slug] = {}
+                for pk, value in values:
+                    if value is not None:
+                        labels.setdefault(pk, []).append(value)
+
+        if self.index_pks and len(field_labels) == len(facets):
+            for pk in collection.values_list('pk', flat=True):
+                for facet in facets:
+                    facet.index_key(pk, field_labels[facet.slug].get(pk),
+                                    inhibit_save=True)
+            return
+
+        for item in self.iter_collection(queryset, facets):
+            key = self.item_key(item)
+            for facet in facets:
+                if facet.slug in field_labels:
+                    facet_labels = field_labels[facet.slug].get(item.pk)
+                else:
+                    facet_labels = facet.get_labels(item)
+                facet.index_key(key, facet_labels, inhibit_save=True)
+
+    def iter_collection(self, queryset=None, facets=None):
+        """
+        Yield the items of `queryset` (by default, the unfiltered collection)
+        in pk order, `chunk_size` at a time. Each chunk loads the relations
+        that `facets` (by default, all of them) declare in
+        `select_related`/`prefetch_related` in bulk, so costs a handful of
+        queries, and only its items are kept in memory.
+        """
+        if queryset is None:
+            queryset = self.unfiltered_collection()
+        if facets is None:
+            facets = list(self)
+        select_related = set()
+        prefetch_related = set()
+        for facet in facets:
+            select_related.update(facet.select_related)
+            prefetch_related.update(facet.prefetch_related)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        queryset = queryset.order_by('pk')
+
+        chunk = list(queryset[:self.chunk_size])
+        while chunk:
+            for item in chunk:
+                yield item
+            if len(chunk) < self.chunk_size:
+                break
+            last_pk = chunk[-1].pk
+            chunk = list(queryset.filter(pk__gt=last_pk)[:self.chunk_size])
+
+    def rebuild_index_parallel(self, processes=None, pool=None, swap=True):
+        """
+        Rebuild the index like `rebuild_index`, but index ranges of pks in
+        `processes` worker processes (by default, one per CPU), each with
+        its own database connection. The partial indexes are merged in pk
+        order, so the result is the same as a serial rebuild.
+
+        Workers instantiate this FacetGroup's class, so it must be
+        importable. Instead of `processes`, a `pool` with a
+        multiprocessing.Pool-like `map` may be given.
+
+        As in `rebuild_index`, the old index stays live until the new one is
+        swapped in, unless `swap` is False.
+        """
+        if swap:
+            self.build_and_swap(lambda new_index:
+                new_index.rebuild_index_parallel(processes, pool, swap=False))
+            return
+        pks = list(self.unfiltered_collection().order_by('pk')
+                   .values_list('pk', flat=True))
+        if pool is None:
+            processes = processes or multiprocessing.cpu_count()
+        else:
+            processes = processes or 1
+        # several ranges per process, so that slow ranges even out
+        n_ranges = min(len(pks), processes * 4)
+        args = []
+        for i in range(n_ranges):
+            lo = pks[i * len(pks) // n_ranges]
+            hi = pks[(i + 1) * len(pks) // n_ranges - 1]
+            args.append((self.__class__, lo, hi))
+
+        if pool is None:
+            # don't share our connections with the forked workers
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(processes)
+            try:
+                partial_indexes = pool.map(index_pk_range, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            partial_indexes = pool.map(index_pk_range, args)
+
+        with self.updating(copy=False):
+            self.clear_items()
+            for partial_index in partial_indexes:
+                self.merge_index(partial_index)
+        self._finish_rebuild()
+
+    def merge_index(self, partial_index):
+        """
+        Add a partial index, as returned by `index_pk_range`, to this one.
+        Where label names differ for the same slug, the first merged wins.
+        """
+        for facet in self:
+            facet.merge_partial_index(partial_index[facet.slug])
+
+    def key_for_pk(self, pk):
+        """
+        Return the key that the item with `pk` is (or was) indexed by.
+        """
+        if self.index_pks:
+            return pk
+        # model instances are equal (and hash the same) if their pks are
+        return self.model(pk=pk)
+
+    def catch_up(self, new_index, keys):
+        # reindex them from the database, as it is now
+        new_index.reindex_pks([key if self.index_pks else key.pk
+                               for key in keys])
+
+    def reindex_pks(self, pks, facets=None):
+        """
+        Bring the index up to date for the items with `pks`, in one update:
+        items that are in the unfiltered collection are reindexed (in
+        `facets`, by default all of them), and the rest (e.g. deleted ones)
+        are unindexed. Costs a few queries per `chunk_size` pks, and one
+        batch of storage writes.
+        """
+        pks = sorted(set(pks))
+        if not pks:
+            return
+        with self.updating():
+            self.unindex_pks(pks, inhibit_save=True, facets=facets)
+            for batch in batches(pks, self.chunk_size):
+                self.index_collection(
+                    self.unfiltered_collection().filter(pk__in=batch), facets)
+            self.save_update()
+
+    def reindex_queryset(self, queryset):
+        """
+        Bring the index up to date for the items of `queryset`, e.g. after
+        queryset.update(), bulk_create() or a raw import, which send no
+        signals. As with `reindex_pks`, items that aren't in the unfiltered
+        collection are unindexed.
+
+        Membership is checked with a subquery, as the matching items are
+        streamed in chunks (see `iter_collection`), and the changes are
+        saved in one batch.
+        """
+        with self.updating():
+            self.unindex_pks(queryset.values_list('pk', flat=True),
+                             inhibit_save=True)
+            self.index_collection(self.unfiltered_collection().filter(
+                pk__in=queryset.values('pk')))
+            self.save_update()
+
+    def unindex_pks(self, pks, inhibit_save=False, facets=None):
+        """
+        Unindex the items with `pks` (from `facets`, by default all of them)
+        in one update, saving the changes in one batch.
+        """
+        if facets is None:
+            facets = list(self)
+        with self.updating():
+            for pk in set(pks):
+                key = self.key_for_pk(pk)
+                for facet in facets:
+                    facet.unindex_key(key, inhibit_save=True)
+            if not inhibit_save:
+                self.save_update()
+
+    def queue_pk(self, pk, using=None):
+        """
+        Queue the item with `pk` for reindexing when the current transaction
+        commits (see `defer_indexing`).
+        """
+        queued = getattr(self._queued, 'pks', None)
+        if queued is None:
+            queued = self._queued.pks = set()
+        queued.add(pk)
+        if getattr(self._queued, 'suspended', 0):
+            return # see `suspend_indexing`
+        # not just for the first pk queued: if a transaction that queued
+        # pks was rolled back, they're still queued, but the flush it
+        # registered is gone.
+        self._flush_on_commit(using)
+
+    def _flush_on_commit(self, using=None):
+        on_commit = getattr(transaction, 'on_commit', None)
+        if on_commit is not None:
+            # once per transaction
+            if not self._flush_registered(using):
+                on_commit(self.flush, using=using)
+        elif not transaction.is_managed(using=using):
+            # we're autocommitting, so the change is already committed
+            self.flush()
+        # otherwise, FacetIndexMiddleware or a flush() will
+
+    def _flush_registered(self, using=None):
+        # whether the current transaction will flush when it commits. A
+        # rollback drops what it would have run on commit.
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        return any(callback[1] == self.flush
+                   for callback in getattr(connection, 'run_on_commit', ()))
+
+    @contextmanager
+    def suspend_indexing(self):
+        """
+        Within this block, signal handlers in this thread don't index the
+        items that change, but just note their pks. They are reindexed in
+        one batch when the block ends (or, with `defer_indexing`, when the
+        transaction commits), e.g.:
+
+            with group.suspend_indexing():
+                for row in feed:
+                    ShopItem.objects.create(**row)
+        """
+        self._queued.suspended = getattr(self._queued, 'suspended', 0) + 1
+        try:
+            yield
+        finally:
+            self._queued.suspended -= 1
+            if not self._queued.suspended:
+                if self.defer_indexing:
+                    self._flush_on_commit()
+                else:
+                    self.flush()
+
+    def _deferring(self):
+        # whether signal handlers should queue pks, rather than index them
+        return self.defer_indexing or getattr(self._queued, 'suspended', 0)
+
+    def flush(self):
+        """
+        Reindex the items queued in this thread, if any, or hand them to the
+        background worker.
+        """
+        queued = getattr(self._queued, 'pks', None)
+        if queued:
+            self._queued.pks = set()
+            if self.worker is not None:
+                self.worker.put(queued)
+            else:
+                self.reindex_pks(queued)
+
+    def wait_until_indexed(self, timeout=None):
+        """
+        Flush this thread's queue, and wait until the background worker (if
+        any) has indexed everything queued. Returns False if that takes
+        longer than `timeout` seconds.
+        """
+        self.flush()
+        if self.worker is None:
+            return True
+        return self.worker.wait_until_indexed(timeout)
+
+    def watch_model(self, model, background=False):
+        """
+        Keep the index up to date as instances of `model` change. If
+        `background` is True, changed items are reindexed by a background
+        thread (see facettools.worker), once their transaction commits.
+        """
+        if background:
+            self.defer_indexing = True
+            if self.worker is None:
+                self.worker = IndexingWorker(self)
+                self.worker.start()
+        if self.defer_indexing:
+            deferring_groups.add(self)
+        self._watched.add(model)
+        self._tracked_fields = self.tracked_fields(model)
+        if self._tracked_fields:
+            post_init.connect(self.post_init, sender=model)
         post_save.connect(self.post_save, sender=model)
         pre_delete.connect(self.pre_delete, sender=model)
         if m2m_changed is not None:
-            m2m_changed.connect(self.m2m_changed, sender=model)
+            # m2m_changed is sent by the relation's through model
+            for field in model._meta.many_to_many:
+                self._m2m_fields[field.rel.through] = field
+                m2m_changed.connect(self.m2m_changed, sender=field.rel.through)
+        # the related models that facets read labels from (see Facet.related)
+        for related_model in self.related_models():
+            pre_save.connect(self.related_pre_save, sender=related_model)
+            post_save.connect(self.related_post_save, sender=related_model)
+            pre_delete.connect(self.related_pre_delete, sender=related_model)
+            post_delete.connect(self.related_post_delete,
+                                sender=related_model)
 
     def unwatch_model(self, model):
-        pre_save.disconnect(self.pre_save, sender=model)
+        """
+        Stop keeping the index up to date with `model`. Once no model is
+        watched, the background worker (if any) indexes what has been
+        queued, and stops.
+        """
+        post_init.disconnect(self.post_init, sender=model)
         post_save.disconnect(self.post_save, sender=model)
         pre_delete.disconnect(self.pre_delete, sender=model)
         if m2m_changed is not None:
-            m2m_changed.disconnect(self.m2m_changed, sender=model)
+            for field in model._meta.many_to_many:
+                m2m_changed.disconnect(self.m2m_changed,
+                                       sender=field.rel.through)
+        for related_model in self.related_models():
+            pre_save.disconnect(self.related_pre_save, sender=related_model)
+            post_save.disconnect(self.related_post_save, sender=related_model)
+            pre_delete.disconnect(self.related_pre_delete,
+                                  sender=related_model)
+            post_delete.disconnect(self.related_post_delete,
+                                   sender=related_model)
+        self._watched.discard(model)
+        if not self._watched and self.worker is not None:
+            self.flush()
+            self.worker.stop()
+            self.worker = None
 
-    def pre_save(self, sender, **kwargs):
-        instance = kwargs.pop('instance')
-        if instance.pk:
-            self.unindex_item(instance)
+    def tracked_fields(self, model):
+        """
+        Return {field name: attribute name} for the fields of `model` that
+        saves are checked for changes to: those that every facet's labels
+        depend on, if every facet says what it depends on (see
+        Facet.depends_on), and those the collection depends on. Otherwise
+        every save reindexes every facet, and nothing is tracked.
+        """
+        if any(facet.depends_on is None for facet in self):
+            return {}
+        names = set(self.collection_depends_on or ())
+        for facet in self:
+            names.update(facet.depends_on)
+        fields = {}
+        for name in names:
+            try:
+                field, field_model, direct, m2m = \
+                    model._meta.get_field_by_name(name)
+            except FieldDoesNotExist:
+                # e.g. a property, which could read any field
+                return {}
+            # relations change through m2m_changed, or other models
+            if direct and not m2m:
+                fields[name] = field.attname
+        return fields
+
+    def _remember(self, instance):
+        # note the tracked values of `instance`, to tell what a save changes
+        instance.__dict__[self._clean_attr] = dict(
+            (name, instance.__dict__.get(attname, NOT_LOADED))
+            for name, attname in self._tracked_fields.items()
+        )
+
+    def changed_fields(self, instance):
+        """
+        Return the names of the tracked fields of `instance` that have
+        changed since it was loaded (or last saved), or None if we can't
+        tell.
+        """
+        clean = instance.__dict__.get(self._clean_attr)
+        if clean is None:
+            return None
+        return set(name for name, attname in self._tracked_fields.items()
+                   if instance.__dict__.get(attname, NOT_LOADED)
+                   != clean[name])
+
+    def affected_facets(self, changed):
+        """
+        Return the facets whose labels depend on any of the `changed` fields
+        or relations.
+        """
+        return [facet for facet in self if facet.depends_on is None
+                or changed.intersection(facet.depends_on)]
+
+    def _may_move(self, changed):
+        # could the change move an item in or out of the collection?
+        return self.collection_depends_on is None or \
+            bool(changed.intersection(self.collection_depends_on))
+
+    def post_init(self, sender, **kwargs):
+        self._remember(kwargs['instance'])
 
     def post_save(self, sender, **kwargs):
         instance = kwargs.pop('instance')
-        if instance in self.unfiltered_collection():
-            self.index_item(instance)
+        if kwargs.get('created') or not self._tracked_fields:
+            changed = None
+        else:
+            changed = self.changed_fields(instance)
+            self._remember(instance)
+            if changed is not None and not self.affected_facets(changed) \
+                    and not self._may_move(changed):
+                return # nothing the index reads has changed
+
+        if self._deferring():
+            self.queue_pk(instance.pk, kwargs.get('using'))
+            return
+        key = self.item_key(instance)
+        is_member = instance in self.unfiltered_collection()
+        if changed is not None and is_member and self.is_indexed(key):
+            facets = self.affected_facets(changed)
+            if not facets:
+                return
+        else:
+            facets = list(self)
+        # readers see the item's old labels or its new ones, never none
+        with self.updating():
+            for facet in facets:
+                facet.unindex_key(key, inhibit_save=True)
+            if is_member:
+                for facet in facets:
+                    facet.index_item(instance, inhibit_save=True)
+            self.save_update()
 
     def pre_delete(self, sender, **kwargs):
         instance = kwargs.pop('instance')
+        if self._deferring():
+            self.queue_pk(instance.pk, kwargs.get('using'))
+            return
         #remove current facets
         self.unindex_item(instance)
 
     def m2m_changed(self, sender, **kwargs):
-        instance = kwargs.pop('instance')
-        if instance in self.unfiltered_collection():
-            self.unindex_item(instance)
-            self.index_item(instance)
+        field = self._m2m_fields[sender]
+        action = kwargs['action']
+        instance = kwargs['instance']
+        changed = set([field.name])
+        if not self.affected_facets(changed) and not self._may_move(changed):
+            return
+
+        if not kwargs['reverse']:
+            if not action.startswith('post_'):
+                return
+            pks = [instance.pk]
+        elif action in ('post_add', 'post_remove'):
+            pks = kwargs['pk_set']
+        elif action == 'pre_clear':
+            # our items losing the related instance aren't given afterwards
+            pks = sender.objects.filter(**{
+                field.m2m_reverse_field_name(): instance.pk
+            }).values_list(field.m2m_field_name(), flat=True)
+            instance.__dict__[self._clean_attr + '_cleared'] = list(pks)
+            return
+        elif action == 'post_clear':
+            pks = instance.__dict__.pop(self._clean_attr + '_cleared', [])
+        else:
+            return
+
+        if self._deferring():
+            for pk in pks:
+                self.queue_pk(pk, kwargs.get('using'))
+        else:
+            self.reindex_pks(pks)
+
+    def related_models(self):
+        return set(related_model for facet in self
+                   for related_model in facet.related)
+
+    def _related(self, related_model):
+        # (facet, path from the items) for the facets that read labels from
+        # `related_model`
+        return [(facet, facet.related[related_model]) for facet in self
+                if related_model in facet.related]
+
+    def related_pks(self, path, instance):
+        """
+        Return the pks of the items that relate to `instance` through the
+        lookup `path`.
+        """
+        return self.model._default_manager.filter(**{path: instance.pk}) \
+            .values_list('pk', flat=True)
+
+    def related_pre_save(self, sender, **kwargs):
+        instance = kwargs['instance']
+        if instance.pk is None:
+            return
+        # the label values the save may change, to rename labels afterwards
+        attrs = set(facet.related_label_field(path)
+                    for facet, path in self._related(sender)) - set([None])
+        if attrs:
+            old = sender._default_manager.filter(pk=instance.pk) \
+                .values(*attrs)
+            instance.__dict__[self._clean_attr + '_related'] = \
+                old[0] if old else {}
+
+    def related_post_save(self, sender, **kwargs):
+        instance = kwargs['instance']
+        old = instance.__dict__.pop(self._clean_attr + '_related', {})
+        if kwargs.get('created'):
+            # nothing relates to it yet
+            return
+        renames = []
+        facets = []
+        pks = set()
+        for facet, path in self._related(sender):
+            attr = facet.related_label_field(path)
+            if attr in old:
+                old_name, new_name = old[attr], getattr(instance, attr)
+                if old_name == new_name:
+                    continue
+                # renames aren't transactional, so deferring groups reindex.
+                # Nor can a label be renamed if it's someone else's too, or
+                # items gain or lose it.
+                if old_name is not None and new_name is not None and \
+                        not self._deferring():
+                    old_slug = slugify(unicode(old_name))
+                    if old_slug == slugify(unicode(new_name)) or \
+                            not self._label_in_use(facet, old_slug):
+                        renames.append((facet, old_name, new_name))
+                        continue
+            facets.append(facet)
+            pks.update(self.related_pks(path, instance))
+
+        if not renames:
+            # (e.g. no name changed), so there may be nothing to do
+            self._reindex_related(pks, facets, kwargs.get('using'))
+            return
+        with self.updating():
+            for facet, old_name, new_name in renames:
+                facet.rename_label(unicode(old_name), unicode(new_name))
+            self._reindex_related(pks, facets, kwargs.get('using'))
+
+    def _label_in_use(self, facet, slug):
+        # whether any item of the label with `slug` still has a value of
+        # `facet.field` with that slug (e.g. from another related row whose
+        # name slugifies the same), once a related row has been renamed
+        facet_label = facet._label_dict.get(slug)
+        if facet_label is None:
+            return False
+        pks = [key if self.index_pks else key.pk
+               for key in facet_label.items]
+        for batch in batches(pks, self.chunk_size):
+            items = self.model._default_manager.filter(pk__in=batch)
+            try:
+                values = items.values_list(facet.field, flat=True)
+            except FieldError:
+                # not a lookup (e.g. it ends in a property)
+                values = [value for item in items
+                          for value in facet.get_labels(item)]
+            if any(value is not None and slugify(unicode(value)) == slug
+                   for value in values):
+                return True
+        return False
+
+    def related_pre_delete(self, sender, **kwargs):
+        instance = kwargs['instance']
+        # the items that relate to it won't, once it's gone
+        pks = set()
+        for facet, path in self._related(sender):
+            pks.update(self.related_pks(path, instance))
+        instance.__dict__[self._clean_attr + '_related_pks'] = pks
+
+    def related_post_delete(self, sender, **kwargs):
+        instance = kwargs['instance']
+        pks = instance.__dict__.pop(self._clean_attr + '_related_pks', ())
+        self._reindex_related(
+            pks, [facet for facet, path in self._related(sender)],
+            kwargs.get('using'))
+
+    def _reindex_related(self, pks, facets, using=None):
+        if self._deferring():
+            for pk in pks:
+                self.queue_pk(pk, using)
+        elif pks and facets:
+            self.reindex_pks(pks, facets)
 
     @property
     def Q(self):
         matches = self.matching_items()
-        ids = [m.id for m in matches]
-        return Q(id__in=ids)
+        if self.index_pks:
+            ids = list(matches)
+        else:
+            ids = [m.pk for m in matches]
+        return Q(pk__in=ids)
 
     def queryset(self):
         return self.model.objects.filter(self.Q)
\ No newline at end of file
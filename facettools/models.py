@@ -0,0 +1,12 @@
+from django.db import models
+
+
+class StoredIndexEntry(models.Model):
+    """
+    A piece of a facet index, saved by facettools.storage.DatabaseStorage.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    data = models.TextField() # base64-encoded
+
+    def __unicode__(self):
+        return self.key
@@ -0,0 +1,175 @@
+"""
+A count engine that works out every label count in a FacetGroup with a few
+vectorized NumPy reductions. Requires numpy.
+
+Use it by setting `count_engine = NumpyCountEngine` on a FacetGroup subclass.
+Each facet's index is kept as a packed-bit label x item matrix, built after
+`rebuild_index` (and again, lazily, after the index changes).
+"""
+import numpy as np
+
+from .bitmaps import ItemBitmap, ItemRegistry
+
+# the number of set bits in each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# matrices are counted this many rows at a time, to bound temporary memory.
+ROWS_PER_BLOCK = 256
+
+
+def row_counts(matrix, mask):
+    """
+    Return the number of bits set in each row of `matrix` & `mask`.
+    """
+    counts = np.empty(len(matrix), dtype=np.intp)
+    for start in xrange(0, len(matrix), ROWS_PER_BLOCK):
+        block = matrix[start:start + ROWS_PER_BLOCK] & mask
+        counts[start:start + ROWS_PER_BLOCK] = POPCOUNT[block].sum(axis=1)
+    return counts
+
+
+def item_ids(items, registry):
+    if isinstance(items, ItemBitmap):
+        return list(items.ids())
+    return map(registry.id_for, items)
+
+
+class NumpyCountEngine(object):
+
+    def __init__(self, group):
+        self.group = group
+        # per facet slug: the label x item matrix, each label's row, and the
+        # slug of each row
+        self.matrices = {}
+        self.rows = {}
+        self.slugs = {}
+        # per range facet (see facettools.ranges): the ids of its items in
+        # order of value, and the sorted arrays they were read from
+        self.sorted_ids = {}
+        self.sorted_sources = {}
+
+        if group.use_bitmaps:
+            # bitmaps already give us dense ids
+            registry = group.item_registry
+        else:
+            registry = ItemRegistry()
+        self.registry = registry
+
+        label_ids = {}
+        for facet in group:
+            label_ids[facet.slug] = [
+                (label.slug, item_ids(label.items, registry))
+                for label in facet._index_labels() if not label.is_all]
+            sorted_values = getattr(facet, 'sorted_values', None)
+            if sorted_values is not None:
+                source = self.sorted_sources[facet.slug] = sorted_values()
+                self.sorted_ids[facet.slug] = np.array(
+                    item_ids(source.keys(), registry), dtype=np.intp)
+        self.n_items = len(registry)
+        # the packed mask of every item
+        self.everything = np.packbits(np.ones(self.n_items, dtype=np.bool_))
+
+        for facet in group:
+            self.slugs[facet.slug] = [slug for slug, ids
+                                      in label_ids[facet.slug]]
+            rows = self.rows[facet.slug] = {}
+            matrix = self.matrices[facet.slug] = np.zeros(
+                (len(label_ids[facet.slug]), (self.n_items + 7) // 8),
+                dtype=np.uint8
+            )
+            row = np.zeros(self.n_items, dtype=np.bool_)
+            for i, (slug, ids) in enumerate(label_ids[facet.slug]):
+                rows[slug] = i
+                row[:] = False
+                row[ids] = True
+                matrix[i] = np.packbits(row)
+
+    def facet_mask(self, facet):
+        """
+        Return the packed mask of items matching `facet`'s selection, or None
+        if the facet doesn't narrow the selection (as in
+        `FacetGroup.matching_items`, an empty selection is ignored).
+        """
+        rows = self.rows[facet.slug]
+        matrix = self.matrices[facet.slug]
+        intersect = facet.select_multiple and facet.intersect_if_multiple
+        selected = []
+        all_selected = False
+        for label in facet.selected():
+            if label.is_all:
+                # it holds every item, so it needs no mask of its own
+                if not intersect:
+                    return self.everything
+                all_selected = True
+                continue
+            selected.append(matrix[rows[label.slug]] if label.slug in rows
+                            else self.label_mask(label))
+        if not selected:
+            return self.everything if all_selected else None
+        op = np.bitwise_and if intersect else np.bitwise_or
+        mask = op.reduce(selected, axis=0)
+        if not mask.any():
+            return None
+        return mask
+
+    def label_mask(self, facet_label):
+        """
+        Return the packed mask of a label the engine wasn't built with: a
+        range selected at query time (see facettools.ranges), whose items
+        are a slice of the facet's items in order of value.
+        """
+        row = np.zeros(self.n_items, dtype=np.bool_)
+        facet = facet_label.facet
+        if facet.slug in self.sorted_ids and \
+                facet.sorted_values() is self.sorted_sources[facet.slug]:
+            start, end = facet._range_slice(facet_label.low, facet_label.high)
+            row[self.sorted_ids[facet.slug][start:end]] = True
+        else:
+            # items the engine hasn't seen can't match anything else anyway
+            ids = [i for i in item_ids(facet_label.items, self.registry)
+                   if i < self.n_items]
+            row[ids] = True
+        return np.packbits(row)
+
+    def _intersect(self, masks):
+        masks = [m for m in masks if m is not None]
+        if not masks:
+            return np.zeros((self.n_items + 7) // 8, dtype=np.uint8)
+        return np.bitwise_and.reduce(masks, axis=0)
+
+    def range_counts(self, facet, ranges):
+        """
+        Return the number of items in each (start, end) slice of a range
+        facet's sorted values that its group's selection counts them
+        against, or None if the engine wasn't built with those values.
+        """
+        if facet.sorted_values() is not self.sorted_sources.get(facet.slug):
+            return None
+        masks = [self.facet_mask(other) for other in facet.group
+                 if other is not facet or
+                 (facet.select_multiple and facet.intersect_if_multiple)]
+        matched = np.unpackbits(self._intersect(masks))[:self.n_items] \
+            .astype(np.bool_)[self.sorted_ids[facet.slug]]
+        # the number matched before each position
+        before = np.concatenate(([0], np.cumsum(matched)))
+        return [int(before[end] - before[start]) for start, end in ranges]
+
+    def compute_counts(self, group=None):
+        """
+        Work out the count of every label of every facet in `group` (see
+        Facet.counts): by default the group the engine was built for, or a
+        selection of it.
+        """
+        facets = list(group or self.group)
+        masks = [self.facet_mask(facet) for facet in facets]
+        everything = self._intersect(masks)
+
+        for i, facet in enumerate(facets):
+            others = self._intersect(masks[:i] + masks[i + 1:])
+            if facet.select_multiple and facet.intersect_if_multiple:
+                counts = row_counts(self.matrices[facet.slug], everything)
+            else:
+                counts = row_counts(self.matrices[facet.slug], others)
+            facet_counts = dict(zip(self.slugs[facet.slug], counts.tolist()))
+            facet_counts[facet.all_label_slug] = int(POPCOUNT[others].sum())
+            facet._counts = facet_counts
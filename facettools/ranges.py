@@ -0,0 +1,737 @@
+"""
+Facets of numeric values, e.g. prices, or dates, whose labels are ranges of
+them.
+
+A RangeFacet indexes one value per item into a sorted array, rather than an
+item set per label. Its labels (the `buckets` it's given, and any range
+selected, e.g. with `?price=20-75`) are worked out from the array by binary
+search, so buckets can be changed at query time without reindexing. The
+array is kept in blocks (see `SortedValues`), and the values by item in
+chunks (see ChunkedItemDict), so that an update only copies (and stores)
+the few that it changes. A
+DateFacet's buckets are the calendar periods (decades, years or months)
+that its dates fall in.
+"""
+import re
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from itertools import chain, izip
+
+from django.utils import dateformat
+
+from .base import Facet, FacetLabel
+from .itemsets import ChunkedItemDict
+from .storage import decode_value, encode_items, encode_value
+from .utils import is_iterable
+
+# the number of values in each block of SortedValues; blocks are split in
+# two once they hold twice as many
+BLOCK_SIZE = 1024
+# "low-high", either of which may be left out, e.g. "20-75", "-10-0", "100-"
+RANGE_SLUG_RE = re.compile(r'^(-?\d*\.?\d*)-(-?\d*\.?\d*)$')
+# the slugs of calendar periods, e.g. "1990s", "2012" and "2012-03"
+PERIOD_SLUG_RES = (
+    ('decade', re.compile(r'^(\d{3}0)s$')),
+    ('year', re.compile(r'^(\d{4})$')),
+    ('month', re.compile(r'^(\d{4})-(\d{2})$')),
+)
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return unicode(value)
+
+
+def parse_value(s):
+    if not s:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+
+def range_slug(low, high):
+    return u"%s-%s" % (format_value(low) if low is not None else u"",
+                       format_value(high) if high is not None else u"")
+
+
+def parse_range_slug(slug):
+    """
+    Return the (low, high) of a range slug, or None if it isn't one.
+    """
+    match = RANGE_SLUG_RE.match(slug)
+    if match is None:
+        return None
+    try:
+        return tuple(map(parse_value, match.groups()))
+    except ValueError:
+        return None
+
+
+def period(value, granularity):
+    """
+    Return the (slug, name, low, high) of the calendar period that the date
+    `value` is in: its 'decade', 'year' or 'month'.
+    """
+    year = value.year
+    if granularity == 'decade':
+        year -= year % 10
+        name = u"%ds" % year
+        return name, name, date(year, 1, 1), date(year + 10, 1, 1)
+    if granularity == 'year':
+        name = unicode(year)
+        return name, name, date(year, 1, 1), date(year + 1, 1, 1)
+    if granularity == 'month':
+        low = date(year, value.month, 1)
+        high = date(year + value.month // 12, value.month % 12 + 1, 1)
+        return (u"%04d-%02d" % (year, value.month),
+                dateformat.format(low, 'F Y'), low, high)
+    raise ValueError("Unknown granularity %r" % granularity)
+
+
+def value_order(pair):
+    # the order of a RangeFacet's sorted arrays: by value, then (as keys
+    # needn't be ordered) by the key's hash, so that a key can be found by
+    # binary search
+    key, value = pair
+    return value, hash(key)
+
+
+class SortedValues(object):
+    """
+    The values of a RangeFacet's items, and their keys, in `value_order`.
+
+    They're kept in a list of blocks, which copies share until they change
+    them, so a change copies a block and the list of them, not every value.
+    Positions are over all the values, as if they were one sorted list.
+    """
+    __slots__ = ('_values', '_keys', '_maxes', '_starts', '_len', '_owned')
+
+    def __init__(self, pairs=()):
+        """
+        Take the (key, value) pairs, already sorted by `value_order`.
+        """
+        pairs = list(pairs)
+        self._values = []
+        self._keys = []
+        # the last (value, key hash) of each block
+        self._maxes = []
+        for start in xrange(0, len(pairs), BLOCK_SIZE):
+            block = pairs[start:start + BLOCK_SIZE]
+            self._values.append([value for key, value in block])
+            self._keys.append([key for key, value in block])
+            key, value = block[-1]
+            self._maxes.append((value, hash(key)))
+        # the position of each block's first value, worked out when needed
+        self._starts = None
+        self._len = len(pairs)
+        # the indexes of the blocks that aren't shared with a copy, or None
+        # if none are
+        self._owned = None
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        # (value, key) pairs
+        return izip(self.values(), self.keys())
+
+    def values(self):
+        return chain.from_iterable(self._values)
+
+    def keys(self):
+        return chain.from_iterable(self._keys)
+
+    def _block_starts(self):
+        if self._starts is None:
+            starts = []
+            n = 0
+            for values in self._values:
+                starts.append(n)
+                n += len(values)
+            self._starts = starts
+        return self._starts
+
+    def bisect(self, value):
+        """
+        Return the position of the first value that isn't less than `value`.
+        """
+        # (value,) sorts before any (value, key hash)
+        i = bisect_left(self._maxes, (value,))
+        if i == len(self._maxes):
+            return self._len
+        return self._block_starts()[i] + bisect_left(self._values[i], value)
+
+    def value_at(self, position):
+        starts = self._block_starts()
+        i = bisect_right(starts, position) - 1
+        return self._values[i][position - starts[i]]
+
+    def keys_between(self, start, end):
+        """
+        Return the keys of the values from position `start` up to `end`.
+        """
+        keys = []
+        starts = self._block_starts()
+        i = max(bisect_right(starts, start) - 1, 0)
+        while i < len(starts) and starts[i] < end:
+            keys.extend(self._keys[i][max(start - starts[i], 0):
+                                      end - starts[i]])
+            i += 1
+        return keys
+
+    def _find(self, value, key_hash):
+        # the block, and the position in it, of the first pair that isn't
+        # less than (value, key_hash): a binary search for the block, then
+        # for the value, then for the key's hash among its keys
+        i = min(bisect_left(self._maxes, (value, key_hash)),
+                len(self._maxes) - 1)
+        values, keys = self._values[i], self._keys[i]
+        lo = bisect_left(values, value)
+        hi = bisect_right(values, value, lo)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if hash(keys[mid]) < key_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        return i, lo
+
+    def _writable_block(self, i):
+        owned = self._owned
+        if owned is not None and i not in owned:
+            self._values[i] = list(self._values[i])
+            self._keys[i] = list(self._keys[i])
+            owned.add(i)
+        return self._values[i], self._keys[i]
+
+    def _renumber(self, i, shift):
+        # blocks after block i have moved by `shift`
+        if self._owned is not None:
+            self._owned = set(j + shift if j > i else j for j in self._owned)
+
+    def insert(self, value, key):
+        key_hash = hash(key)
+        self._starts = None
+        self._len += 1
+        if not self._maxes:
+            self._values.append([value])
+            self._keys.append([key])
+            self._maxes.append((value, key_hash))
+            if self._owned is not None:
+                self._owned.add(0)
+            return
+        i, j = self._find(value, key_hash)
+        values, keys = self._writable_block(i)
+        values.insert(j, value)
+        keys.insert(j, key)
+        self._maxes[i] = (values[-1], hash(keys[-1]))
+        if len(values) > 2 * BLOCK_SIZE:
+            # split it in two
+            self._values[i:i + 1] = [values[:BLOCK_SIZE], values[BLOCK_SIZE:]]
+            self._keys[i:i + 1] = [keys[:BLOCK_SIZE], keys[BLOCK_SIZE:]]
+            self._maxes.insert(i, (values[BLOCK_SIZE - 1],
+                                   hash(keys[BLOCK_SIZE - 1])))
+            self._renumber(i, 1)
+            if self._owned is not None:
+                self._owned.add(i + 1)
+
+    def remove(self, value, key):
+        i, j = self._find(value, key_hash=hash(key))
+        # past any other keys with the same value and hash
+        while self._keys[i][j] != key:
+            j += 1
+            if j == len(self._keys[i]):
+                i += 1
+                j = 0
+        values, keys = self._writable_block(i)
+        del values[j]
+        del keys[j]
+        self._starts = None
+        self._len -= 1
+        if values:
+            self._maxes[i] = (values[-1], hash(keys[-1]))
+        else:
+            del self._values[i]
+            del self._keys[i]
+            del self._maxes[i]
+            if self._owned is not None:
+                self._owned.discard(i)
+            self._renumber(i, -1)
+
+    def copy(self):
+        """
+        Return a copy that shares my blocks, until either of us changes them.
+        """
+        result = SortedValues.__new__(SortedValues)
+        result._values = list(self._values)
+        result._keys = list(self._keys)
+        result._maxes = list(self._maxes)
+        result._starts = self._starts
+        result._len = self._len
+        result._owned = set()
+        self._owned = set()
+        return result
+
+
+def range_sort_key(facet_label):
+    # open-ended ranges first and last
+    return (facet_label.low is not None, facet_label.low,
+            facet_label.high is None, facet_label.high)
+
+
+class RangeLabel(FacetLabel):
+    """
+    A label of a RangeFacet: the items whose values are at least `low` and
+    less than `high` (either may be None, for no limit).
+    """
+
+    is_bucket = False
+
+    def __init__(self, facet, name, slug=None, low=None, high=None,
+                 is_bucket=False, **kwargs):
+        self.low = low
+        self.high = high
+        # whether I'm one of the facet's buckets, or a range selected
+        self.is_bucket = is_bucket
+        # the facet's sorted arrays that `_items` was worked out from
+        self._items_source = None
+        super(RangeLabel, self).__init__(facet, name, slug, **kwargs)
+
+    def initialise_items(self):
+        # worked out when needed
+        return None
+
+    @property
+    def items(self):
+        sorted_values = self.facet.sorted_values()
+        if self._items is None or self._items_source is not sorted_values:
+            items = self.facet.group.new_item_set()
+            for key in self.facet.range_keys(self.low, self.high):
+                items.add(key)
+            self._items = items
+            self._items_source = sorted_values
+        return self._items
+
+    def copy_for(self, facet):
+        # share whatever items have been worked out, but don't work them out
+        facet_label = object.__new__(self.__class__)
+        facet_label.__dict__.update(self.__dict__)
+        facet_label.facet = facet
+        facet_label.invalidate()
+        return facet_label
+
+
+class RangeFacet(Facet):
+    """
+    A facet of one numeric value per item (read like any facet's labels,
+    e.g. from `field`; the first is used if there are several).
+
+    `buckets` is a list of (name, low, high) ranges to show as labels; it
+    can be replaced at query time with `set_buckets`. Any other range can
+    be selected by its slug (see `range_slug`). Ranges include their low
+    end, but not their high end.
+    """
+    _RangeLabelClass = RangeLabel
+    # the index is a sorted array, not label item sets
+    supports_snapshots = False
+    index_attributes = Facet.index_attributes + ('_values', '_sorted')
+    # the sorted values of the items that labels are counted against (see
+    # `count_label`), worked out once per selection
+    _matched = None
+
+    def __init__(self, name, group, buckets=(), **kwargs):
+        self.buckets = list(buckets)
+        default_order = kwargs.get('sort_key') is None and \
+            kwargs.get('cmp_func') is None
+        if default_order:
+            kwargs['sort_key'] = range_sort_key
+        super(RangeFacet, self).__init__(name, group, **kwargs)
+        if default_order:
+            self.sort_uses_counts = False
+
+    def clear_items(self):
+        super(RangeFacet, self).clear_items()
+        # item key -> value
+        self._values = ChunkedItemDict()
+        # SortedValues, built when first needed
+        self._sorted = None
+        self._add_buckets()
+
+    def _add_buckets(self):
+        for name, low, high in self.buckets:
+            slug = range_slug(low, high)
+            if slug in self._label_dict: # kept, since it's selected
+                continue
+            self._label_dict[slug] = self._RangeLabelClass(
+                facet=self, name=name, slug=slug, low=low, high=high,
+                is_bucket=True, is_default=slug in self.default_selected_slugs)
+
+    def set_buckets(self, buckets):
+        """
+        Replace my buckets with `buckets`, keeping any selected ranges.
+        """
+        self.buckets = list(buckets)
+        # a new dict, since readers may be iterating over the old one
+        self._label_dict = dict(
+            (slug, facet_label)
+            for slug, facet_label in self._label_dict.items()
+            if facet_label.is_all or not facet_label.is_bucket
+            or facet_label.is_selected
+        )
+        self._add_buckets()
+        self.labels = None
+
+    def sorted_values(self):
+        """
+        Return the SortedValues of the indexed items: sorted by value (and
+        then by the key's hash).
+
+        They're sorted when first needed after a rebuild (by the group's
+        `update()`, so that selections share them), then kept in order.
+        """
+        if self._sorted is None:
+            self._sorted = SortedValues(
+                sorted(self._values.iteritems(), key=value_order))
+        return self._sorted
+
+    def sort(self, *args, **kwargs):
+        self.sorted_values()
+        super(RangeFacet, self).sort(*args, **kwargs)
+
+    def published_copy(self):
+        # sorted once, for every selection
+        self.sorted_values()
+        return super(RangeFacet, self).published_copy()
+
+    def _range_slice(self, low, high):
+        sorted_values = self.sorted_values()
+        start = 0 if low is None else sorted_values.bisect(low)
+        end = len(sorted_values) if high is None \
+            else sorted_values.bisect(high)
+        return start, max(start, end)
+
+    def range_keys(self, low, high):
+        """
+        Return the keys of the items with values in the range.
+        """
+        start, end = self._range_slice(low, high)
+        return self.sorted_values().keys_between(start, end)
+
+    def parse_slug(self, slug):
+        """
+        Return the (name, low, high) of the range that `slug` selects, or
+        None if it doesn't.
+        """
+        bounds = parse_range_slug(slug)
+        if bounds is None:
+            return None
+        return (slug,) + bounds
+
+    def get_or_create_range(self, low, high, name=None, slug=None):
+        if slug is None:
+            slug = range_slug(low, high)
+        if slug not in self._label_dict:
+            label_dict = dict(self._label_dict)
+            label_dict[slug] = self._RangeLabelClass(
+                facet=self, name=name or slug, slug=slug, low=low, high=high)
+            self._label_dict = label_dict
+        return self._label_dict[slug]
+
+    def index_key(self, key, facet_labels, inhibit_save=False):
+        value = facet_labels
+        if is_iterable(value):
+            value = list(value)
+            value = value[0] if value else None
+        if key in self._values:
+            self._remove_value(key)
+        if value is not None:
+            self._writable_values()[key] = value
+            if self._sorted is not None:
+                self._writable_sorted().insert(value, key)
+        # add it to 'all'
+        super(RangeFacet, self).index_key(key, None, inhibit_save)
+        if not inhibit_save and self.group.saves_changes:
+            self.group.store_many(self.stored_state('_values'))
+
+    def _writable_values(self):
+        return self.group.writable(self, '_values', ChunkedItemDict.copy)
+
+    def _writable_sorted(self):
+        return self.group.writable(self, '_sorted', SortedValues.copy)
+
+    def _remove_value(self, key):
+        value = self._writable_values().pop(key)
+        if self._sorted is not None:
+            self._writable_sorted().remove(value, key)
+
+    def copy_key(self, facet, key):
+        self.unindex_key(key, inhibit_save=True)
+        if facet.group.is_indexed(key):
+            self.index_key(key, facet._values.get(key), inhibit_save=True)
+
+    def item_labels(self, key):
+        # no label but 'all' holds items in the index
+        if self._item_labels is None:
+            self._item_labels = {}
+        return ()
+
+    def unindex_key(self, key, inhibit_save=False):
+        if key in self._values:
+            self._remove_value(key)
+            if not inhibit_save and self.group.saves_changes:
+                self.group.store_many(self.stored_state('_values'))
+        super(RangeFacet, self).unindex_key(key, inhibit_save)
+
+    def select_slugs(self, *slugs):
+        # selected ranges that aren't buckets become labels
+        for slug in slugs:
+            if slug not in self._label_dict:
+                parsed = self.parse_slug(slug)
+                if parsed is not None:
+                    name, low, high = parsed
+                    self.get_or_create_range(low, high, name, slug)
+        super(RangeFacet, self).select_slugs(*slugs)
+
+    def clear_selection(self):
+        # forget the ranges that were selected
+        self._label_dict = dict(
+            (slug, facet_label)
+            for slug, facet_label in self._label_dict.items()
+            if facet_label.is_all or facet_label.is_bucket
+        )
+        super(RangeFacet, self).clear_selection()
+
+    def invalidate(self):
+        super(RangeFacet, self).invalidate()
+        self._matched = None
+
+    def _matched_values(self):
+        if self._matched is None:
+            others, base = self._count_bases()
+            if not self.hide_all and \
+                    len(base) == len(self[self.all_label_slug].items):
+                # nothing else is selected
+                self._matched = self.sorted_values()
+            else:
+                values = self._values
+                self._matched = sorted(values[key] for key in base
+                                       if key in values)
+        return self._matched
+
+    def _range_counts(self, facet_labels):
+        # the counts of ranges: from the engine, if it has my sorted values,
+        # or else with two binary searches each of the values of the items
+        # they're counted against
+        engine = self.group.get_count_engine()
+        if engine is not None:
+            counts = engine.range_counts(self, [
+                self._range_slice(facet_label.low, facet_label.high)
+                for facet_label in facet_labels])
+            if counts is not None:
+                return counts
+        matched = self._matched_values()
+        if matched is self.sorted_values():
+            return [end - start for start, end in (
+                self._range_slice(facet_label.low, facet_label.high)
+                for facet_label in facet_labels)]
+        return [(len(matched) if facet_label.high is None
+                 else bisect_left(matched, facet_label.high)) -
+                (0 if facet_label.low is None
+                 else bisect_left(matched, facet_label.low))
+                for facet_label in facet_labels]
+
+    def count_label(self, facet_label):
+        if facet_label.is_all:
+            return super(RangeFacet, self).count_label(facet_label)
+        return self._range_counts([facet_label])[0]
+
+    def compute_counts(self, facet_labels=None):
+        # a handful of labels, so they're all counted, in one go
+        labels = self._label_dict.values() if facet_labels is None \
+            else facet_labels
+        ranges = [facet_label for facet_label in labels
+                  if not facet_label.is_all]
+        counts = dict(zip([facet_label.slug for facet_label in ranges],
+                          self._range_counts(ranges)))
+        for facet_label in labels:
+            if facet_label.is_all:
+                counts[facet_label.slug] = \
+                    super(RangeFacet, self).count_label(facet_label)
+        if facet_labels is None:
+            self._counts = counts
+        else:
+            for facet_label in facet_labels:
+                facet_label._count = counts[facet_label.slug]
+
+    def sorted_slugs(self):
+        # a handful of ranges, and selections change them
+        return [facet_label.slug for facet_label in sorted(
+            (facet_label for facet_label in self._label_dict.values()
+             if not facet_label.is_all), key=self.sort_key)]
+
+    def _values_data(self, chunks):
+        # each of my values' `chunks`, stored like a label
+        return dict(("%s___values%d" % (self.key, i),
+                     encode_value(self._values.chunks()[i]))
+                    for i in chunks)
+
+    def stored_state(self, name):
+        if name == '_values':
+            chunks = self._values.changed_chunks()
+            data = self._values_data(chunks)
+            if len(chunks) == len(self._values.chunks()):
+                # they may have been split
+                data[self.key] = self._manifest()
+            return data
+        return super(RangeFacet, self).stored_state(name)
+
+    def _manifest(self):
+        # 'all', and the chunks of my values
+        labels = [('_values%d' % i, None)
+                  for i in xrange(len(self._values.chunks()))]
+        if not self.hide_all:
+            labels.append((self.all_label_slug, self.all_label))
+        return encode_value(labels)
+
+    def stored_data(self):
+        data = self._values_data(range(len(self._values.chunks())))
+        data[self.key] = self._manifest()
+        if not self.hide_all:
+            facet_label = self[self.all_label_slug]
+            data[facet_label.key] = encode_items(facet_label.items)
+        return data
+
+    def load(self, data=None):
+        if data is None:
+            data = self.group.load_stored(self.key)
+        if data is None:
+            return False
+        self.clear_items()
+        chunks = [slug for slug, name in decode_value(data)
+                  if slug.startswith('_values')]
+        # as they were stored, so that changes store the same chunks
+        self._values = ChunkedItemDict(n_chunks=max(len(chunks), 1))
+        for slug in chunks:
+            values = self.group.load_stored("%s__%s" % (self.key, slug))
+            if values is not None:
+                for key, value in decode_value(values).iteritems():
+                    self._values[key] = value
+        if not self.hide_all:
+            facet_label = self[self.all_label_slug]
+            self._stored_slugs = set([facet_label.slug])
+            facet_label._items = facet_label.initialise_items()
+            self._stored_slugs = set()
+        return True
+
+    def partial_index(self):
+        facet_label = self._label_dict.get(self.all_label_slug)
+        return (dict(self._values.iteritems()),
+                list(facet_label.items) if facet_label is not None else [])
+
+    def merge_partial_index(self, partial_index):
+        values, keys = partial_index
+        for key in keys or values:
+            self.index_key(key, values.get(key), inhibit_save=True)
+
+
+class DateFacet(RangeFacet):
+    """
+    A facet of one date (or datetime, indexed as its date) per item, whose
+    buckets are the calendar periods of `granularity` ('decade', 'year' or
+    'month') that have items. They're rolled up from the sorted dates when
+    the labels are sorted, so `set_granularity` can change them at query
+    time without reindexing. Any period can be selected by its slug, e.g.
+    "1990s", "2012" or "2012-03".
+    """
+
+    index_attributes = RangeFacet.index_attributes + (
+        '_periods', '_buckets_from')
+
+    def __init__(self, name, group, granularity='year', **kwargs):
+        self.granularity = granularity
+        # the (index generation, granularity) that my buckets were rolled up
+        # for
+        self._buckets_from = None
+        super(DateFacet, self).__init__(name, group, **kwargs)
+
+    def clear_items(self):
+        # granularity -> (index generation, periods), kept for copies of me
+        # for selections too (see `periods`)
+        self._periods = {}
+        super(DateFacet, self).clear_items()
+
+    def index_key(self, key, facet_labels, inhibit_save=False):
+        value = facet_labels
+        if is_iterable(value):
+            value = list(value)
+            value = value[0] if value else None
+        # dates and datetimes don't compare
+        if isinstance(value, datetime):
+            value = value.date()
+        super(DateFacet, self).index_key(key, value, inhibit_save)
+
+    def periods(self):
+        """
+        Return the (slug, name, low, high) of each period that has items, in
+        order. They're rolled up with a binary search per period, once per
+        change to the index (for each granularity), and kept on the facet
+        that selections are copies of, so that they share them.
+        """
+        source = self._source or self
+        generation = self.group.index_generation
+        periods = source._periods.get(self.granularity)
+        if periods is not None and periods[0] == generation:
+            return periods[1]
+        sorted_values = self.sorted_values()
+        periods = []
+        i = 0
+        while i < len(sorted_values):
+            periods.append(period(sorted_values.value_at(i), self.granularity))
+            i = sorted_values.bisect(periods[-1][3])
+        # a published index doesn't change; the live one, between updates
+        if source is not self or generation % 2 == 0:
+            source._periods = dict(source._periods)
+            source._periods[self.granularity] = (generation, periods)
+        return periods
+
+    def _add_buckets(self):
+        if not self._values:
+            # nothing to roll up (and nothing to sort, while rebuilding)
+            self._buckets_from = None
+            return
+        self._buckets_from = (self.group.index_generation, self.granularity)
+        for slug, name, low, high in self.periods():
+            if slug in self._label_dict: # kept, since it's selected
+                continue
+            self._label_dict[slug] = self._RangeLabelClass(
+                facet=self, name=name, slug=slug, low=low, high=high,
+                is_bucket=True, is_default=slug in self.default_selected_slugs)
+
+    def set_granularity(self, granularity):
+        """
+        Make my buckets the periods of `granularity`, keeping any selected.
+        """
+        self.granularity = granularity
+        self.set_buckets(())
+
+    def sort(self, *args, **kwargs):
+        if self._buckets_from != (self.group.index_generation,
+                                  self.granularity):
+            # the dates have changed
+            self.set_buckets(())
+        super(DateFacet, self).sort(*args, **kwargs)
+
+    def parse_slug(self, slug):
+        for granularity, regex in PERIOD_SLUG_RES:
+            match = regex.match(slug)
+            if match is not None:
+                try:
+                    value = date(*(map(int, match.groups()) + [1, 1])[:3])
+                except ValueError:
+                    return None
+                slug, name, low, high = period(value, granularity)
+                return name, low, high
+        return None
@@ -0,0 +1,241 @@
+"""
+Binary snapshots of a facet index, for workers to memory-map.
+
+A snapshot file is a header, then a packed array of little-endian 64-bit
+item keys for each label, then a table of contents that gives the labels of
+each facet (slug, name, offset and length of its array). Since the file is
+memory-mapped, every process that opens it shares the same physical pages:
+labels' items are read in place, through read-only views of their arrays
+(see `SnapshotItems`), and only copied into sets of their own to change them.
+
+Snapshots need integer item keys, e.g. ModelFacetGroup.index_pks.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from bisect import bisect_left
+from itertools import imap
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy as np
+except ImportError:
+    # views fall back to reading keys with struct
+    np = None
+
+MAGIC = 'FACETSNP'
+# change this when the file layout changes
+FORMAT_VERSION = 1
+# magic, format version, the group's storage_version, contents offset and
+# length
+HEADER = struct.Struct('<8sIIQQ')
+KEY_SIZE = 8
+KEY = struct.Struct('<q')
+# keys are read this many at a time when iterating over a view
+KEYS_PER_READ = 4096
+
+
+def write_snapshot(group, path):
+    """
+    Write the index of `group` to a snapshot file at `path`. The file is
+    written alongside and then moved into place, so that processes opening
+    it never see a partial snapshot.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write('\0' * HEADER.size) # filled in at the end
+        offset = HEADER.size
+        contents = {}
+        for facet in group:
+            if not facet.supports_snapshots:
+                raise ValueError("Snapshots can't store %r" % facet)
+            labels = contents[facet.slug] = []
+            for facet_label in facet._label_dict.values():
+                keys = sorted(facet_label.items)
+                if not all(isinstance(key, (int, long)) for key in keys):
+                    raise ValueError("Snapshots need integer item keys, "
+                                     "e.g. from index_pks")
+                f.write(struct.pack('<%dq' % len(keys), *keys))
+                labels.append((facet_label.slug, facet_label.name, offset,
+                               len(keys)))
+                offset += len(keys) * KEY_SIZE
+
+        data = zlib.compress(pickle.dumps(
+            {'key': group.key, 'facets': contents}, pickle.HIGHEST_PROTOCOL))
+        f.write(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, group.storage_version,
+                            offset, len(data)))
+    except Exception:
+        f.close()
+        os.remove(temp_path)
+        raise
+    f.close()
+    os.rename(temp_path, path)
+
+
+class Snapshot(object):
+    """
+    An open, memory-mapped snapshot file.
+    """
+
+    def __init__(self, mm, contents):
+        self.mm = mm
+        # facet slug -> list of (label slug, name, offset, length)
+        self.facets = contents['facets']
+
+    @classmethod
+    def open(cls, path, group):
+        """
+        Return the snapshot at `path`, or None if there isn't one, or it
+        wasn't written by this version of facettools for this version of
+        `group`.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            # the mapping stays valid
+            f.close()
+
+        magic, format_version, storage_version, offset, length = \
+            HEADER.unpack_from(mm, 0)
+        if (magic != MAGIC or format_version != FORMAT_VERSION
+                or storage_version != group.storage_version):
+            mm.close()
+            return None
+        contents = pickle.loads(zlib.decompress(mm[offset:offset + length]))
+        if contents['key'] != group.key or \
+                set(contents['facets']) != set(facet.slug for facet in group):
+            mm.close()
+            return None
+        return cls(mm, contents)
+
+    def items(self, offset, length, new_set=set):
+        """
+        Return a read-only view of the `length` keys at `offset`.
+        """
+        return SnapshotItems(self, offset, length, new_set)
+
+
+class PackedKeys(object):
+    """
+    A sequence of the packed keys at `offset` in `mm`, read one at a time,
+    for binary searches when numpy isn't installed.
+    """
+
+    def __init__(self, mm, offset, length):
+        self.mm = mm
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return KEY.unpack_from(self.mm, self.offset + i * KEY_SIZE)[0]
+
+
+class SnapshotItems(object):
+    """
+    The items of a label in a snapshot: a read-only view of its sorted keys
+    in the memory-mapped file, so that processes share their pages rather
+    than each reading them into a set. Membership is a binary search.
+
+    Supports the reading part of the `set` API that facettools uses; `copy`
+    returns a new set (made with `new_set`) to change.
+    """
+    read_only = True
+
+    def __init__(self, snapshot, offset, length, new_set=set):
+        self.mm = snapshot.mm
+        self.offset = offset
+        self.length = length
+        self.new_set = new_set
+        if np is not None:
+            self.keys = np.frombuffer(self.mm, dtype='<i8', count=length,
+                                      offset=offset)
+        else:
+            self.keys = PackedKeys(self.mm, offset, length)
+
+    def _read(self, start, stop):
+        stop = min(stop, self.length)
+        if np is not None:
+            return self.keys[start:stop].tolist()
+        return struct.unpack_from('<%dq' % (stop - start), self.mm,
+                                  self.offset + start * KEY_SIZE)
+
+    def __iter__(self):
+        for start in xrange(0, self.length, KEYS_PER_READ):
+            for key in self._read(start, start + KEYS_PER_READ):
+                yield key
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, key):
+        if not isinstance(key, (int, long)) or \
+                not -2 ** 63 <= key < 2 ** 63:
+            return False
+        if np is not None:
+            i = int(self.keys.searchsorted(key))
+        else:
+            i = bisect_left(self.keys, key)
+        return i < self.length and self.keys[i] == key
+
+    def intersection_count(self, other):
+        """
+        Return len(self & other), without building the intersection.
+        """
+        if len(other) >= self.length or isinstance(other, SnapshotItems):
+            return sum(imap(other.__contains__, self))
+        if np is not None:
+            # search for all of the other's keys at once
+            keys = np.fromiter(other, dtype=np.int64, count=len(other))
+            found = self.keys.searchsorted(keys)
+            found[found == self.length] = 0
+            return int((self.keys[found] == keys).sum()) \
+                if self.length else 0
+        return sum(imap(self.__contains__, other))
+
+    def copy(self):
+        items = self.new_set()
+        items |= set(self)
+        return items
+
+    def __and__(self, other):
+        if len(other) < self.length:
+            return set(key for key in other if key in self)
+        return set(key for key in self if key in other)
+
+    def __or__(self, other):
+        items = self.copy()
+        items |= other
+        return items
+
+    __rand__ = __and__
+    __ror__ = __or__
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<%s: %s items>" % (self.__class__.__name__, self.length)
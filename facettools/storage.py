@@ -0,0 +1,235 @@
+"""
+Storage backends for facet indexes.
+
+Set `storage` on a FacetGroup subclass to one of these, and `rebuild_index`
+will save the index, so that other processes can `load_index` it instead of
+rebuilding it from the database.
+
+A backend stores strings of bytes by key, with `get`, `set` and `delete`,
+and batched `get_many`, `set_many` and `delete_many` that each cost a few
+round trips at most, however many keys they are given.
+"""
+import base64
+import os
+import re
+import struct
+import tempfile
+import zlib
+from hashlib import md5
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# keys that are longer than this, or contain other characters, are hashed
+MAX_KEY_LENGTH = 200
+SAFE_KEY_RE = re.compile(r'^[\w.-]+$')
+
+
+def safe_key(key):
+    """
+    Return a version of `key` that any backend can use as-is.
+    """
+    if len(key) <= MAX_KEY_LENGTH and SAFE_KEY_RE.match(key):
+        return key
+    prefix = re.sub(r'[^\w.-]', '_', key)[:MAX_KEY_LENGTH - 33]
+    return "%s.%s" % (prefix, md5(key.encode('utf-8')).hexdigest())
+
+
+def batches(seq, size):
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def encode_items(items):
+    """
+    Encode a set of keys compactly. Integer keys (e.g. pks) are sorted and
+    delta-encoded before compression; anything else is pickled.
+    """
+    keys = list(items)
+    if all(isinstance(key, (int, long)) for key in keys):
+        keys.sort()
+        deltas = [b - a for a, b in zip([0] + keys, keys)]
+        try:
+            return 'd' + zlib.compress(
+                struct.pack('<%dq' % len(deltas), *deltas))
+        except struct.error: # too big for 64 bits
+            pass
+    return encode_value(keys)
+
+
+def decode_items(data):
+    """
+    Return the list of keys encoded by `encode_items`.
+    """
+    if data[0] != 'd':
+        return decode_value(data)
+    data = zlib.decompress(data[1:])
+    keys = []
+    key = 0
+    for delta in struct.unpack('<%dq' % (len(data) // 8), data):
+        key += delta
+        keys.append(key)
+    return keys
+
+
+def encode_value(value):
+    return 'p' + zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def decode_value(data):
+    return pickle.loads(zlib.decompress(data[1:]))
+
+
+class CacheStorage(object):
+    """
+    Stores the index in a Django cache. Make sure the cache's timeout (or
+    the one given) is long enough that the index isn't evicted between
+    rebuilds, or workers will have to rebuild it themselves.
+    """
+
+    def __init__(self, cache='default', timeout=None):
+        if isinstance(cache, basestring):
+            from django.core.cache import get_cache
+            cache = get_cache(cache)
+        self.cache = cache
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(safe_key(key))
+
+    def set(self, key, data):
+        self.cache.set(safe_key(key), data, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(safe_key(key))
+
+    def get_many(self, keys):
+        safe_keys = dict((safe_key(key), key) for key in keys)
+        found = self.cache.get_many(safe_keys.keys())
+        return dict((safe_keys[key], data) for key, data in found.items())
+
+    def set_many(self, data):
+        self.cache.set_many(
+            dict((safe_key(key), value) for key, value in data.items()),
+            self.timeout
+        )
+
+    def delete_many(self, keys):
+        self.cache.delete_many([safe_key(key) for key in keys])
+
+
+class DatabaseStorage(object):
+    """
+    Stores the index in the database, in facettools' StoredIndexEntry table.
+    """
+    # keys per query, to stay within databases' limits on parameters
+    batch_size = 500
+
+    def _model(self):
+        from .models import StoredIndexEntry
+        return StoredIndexEntry
+
+    def get(self, key):
+        try:
+            entry = self._model().objects.get(key=safe_key(key))
+        except self._model().DoesNotExist:
+            return None
+        return base64.b64decode(entry.data)
+
+    def set(self, key, data):
+        key = safe_key(key)
+        data = base64.b64encode(data)
+        if not self._model().objects.filter(key=key).update(data=data):
+            self._model().objects.create(key=key, data=data)
+
+    def delete(self, key):
+        self._model().objects.filter(key=safe_key(key)).delete()
+
+    def get_many(self, keys):
+        safe_keys = dict((safe_key(key), key) for key in keys)
+        result = {}
+        for batch in batches(safe_keys.keys(), self.batch_size):
+            entries = self._model().objects.filter(key__in=batch) \
+                .values_list('key', 'data')
+            for key, data in entries:
+                result[safe_keys[key]] = base64.b64decode(data)
+        return result
+
+    def set_many(self, data):
+        from django.db import router, transaction
+        model = self._model()
+        db = router.db_for_write(model)
+        entries = dict((safe_key(key), base64.b64encode(value))
+                       for key, value in data.items())
+        for batch in batches(sorted(entries), self.batch_size):
+            # so that the batch's entries are never missing, or lost if the
+            # insert fails
+            with transaction.commit_on_success(using=db):
+                model.objects.using(db).filter(key__in=batch).delete()
+                model.objects.using(db).bulk_create(
+                    [model(key=key, data=entries[key]) for key in batch])
+
+    def delete_many(self, keys):
+        keys = [safe_key(key) for key in keys]
+        for batch in batches(keys, self.batch_size):
+            self._model().objects.filter(key__in=batch).delete()
+
+
+class FileStorage(object):
+    """
+    Stores the index as one file per key in a local directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, safe_key(key))
+
+    def get(self, key):
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def set(self, key, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # write to a temporary file, then move it into place, so that readers
+        # never see a partly-written file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    # local files have no round trips to save
+    def get_many(self, keys):
+        result = {}
+        for key in keys:
+            data = self.get(key)
+            if data is not None:
+                result[key] = data
+        return result
+
+    def set_many(self, data):
+        for key, value in data.items():
+            self.set(key, value)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
@@ -1,4 +1,13 @@
 from .base import *
 from .signals import *
+from .bitmaps import *
+from .itemsets import *
+from .keys import *
+from .numpy_engine import *
+from .indexing import *
+from .selection import *
+from .storage import *
+from .snapshot import *
 
-#TODO: test storage of facet labels
\ No newline at end of file
+from .ranges import *
+from .worker import *
@@ -1,53 +1,18 @@
+from operator import attrgetter
+
 from django.test import TestCase
 from django.utils.datastructures import SortedDict
 
+from facettools.utils import intersection_count
+
 from .models import *
-from .utils import check_counts
+from .utils import check_counts, create_shop_items
 
 
 class TestSimpleFacets(TestCase):
 
     def setUp(self):
-        self.red = Colour.objects.create(name="red")
-        self.orange = Colour.objects.create(name="orange")
-        self.yellow = Colour.objects.create(name="yellow")
-        self.green = Colour.objects.create(name="green")
-        self.blue = Colour.objects.create(name="blue")
-        self.indigo = Colour.objects.create(name="indigo")
-        self.violet = Colour.objects.create(name="violet")
-
-        self.null_item = ShopItem.objects.create(name="vacuum")
-        self.free_violet_shirt = ShopItem.objects.create(name="violet shirt",
-                                                 dollars=0)
-        self.free_violet_shirt.colours.add(self.violet)
-
-        self.red_shirt = ShopItem.objects.create(name="red shirt",
-                                                 dollars=50)
-        self.red_shirt.colours.add(self.red)
-
-        self.green_shirt = ShopItem.objects.create(name="green shirt",
-                                                         dollars=50)
-        self.green_shirt.colours.add(self.green)
-
-        self.blue_shirt = ShopItem.objects.create(name="blue shirt",
-                                                         dollars=50)
-        self.blue_shirt.colours.add(self.blue)
-
-        self.red_and_yellow_shirt = ShopItem.objects.create(
-            name="red and yellow shirt", dollars=100
-        )
-        self.red_and_yellow_shirt.colours.add(self.red, self.yellow)
-
-        self.rainbow_shirt = ShopItem.objects.create(
-            name="rainbow shirt", dollars=400
-        )
-        self.rainbow_shirt.colours.add(*list(Colour.objects.all()))
-
-        self.old_fashioned_shirt = ShopItem.objects.create(
-            name="archived shirt", dollars = 2,
-            is_archived=True,
-        )
-        self.old_fashioned_shirt.colours.add(self.yellow)
+        create_shop_items(self)
 
         self.f = ShopItemFacetGroup()
         self.f.rebuild_index()
@@ -444,3 +409,74 @@ class TestSimpleFacets(TestCase):
         self.f.colours.select_slugs('maroon')
         self.f.update()
         self.assertEqual(set(self.f.matching_items()), set(ShopItem.objects.filter(is_archived=False)))
+
+    def test_shared_intersections(self):
+        self.f.colours.select_slugs('red')
+        self.f.update()
+
+        calls = []
+        price_matching_items = self.f.price.matching_items
+        def _matching_items():
+            calls.append(1)
+            return price_matching_items()
+        self.f.price.matching_items = _matching_items
+
+        # the labels of a facet share the intersection of the other facets
+        counts = [x.count for x in self.f.colours.labels]
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(counts, [7, 2, 2, 1, 1, 3, 2, 2])
+        counts = [x.count for x in self.f.colours.labels]
+        self.assertEqual(len(calls), 1)
+
+        # until the selection changes
+        self.f.colours.select_slugs('blue')
+        self.f.update()
+        del calls[:]
+        counts = [x.count for x in self.f.colours.labels]
+        self.assertEqual(len(calls), 1)
+
+    def test_counts_dont_build_items(self):
+        self.f.tags.select_slugs('shirt')
+        self.f.update()
+        for facet in self.f:
+            for label in facet.labels:
+                label.count
+                self.assertEqual(label._matching_items, None)
+        self.assertEqual(len(self.f.tags['red'].matching_items()), 3)
+        self.assertEqual(intersection_count(set([1, 2, 3]), set([2, 3, 4])),
+                         2)
+
+    def test_top_labels(self):
+        self.f.clear_selection()
+        self.f.update()
+        full = [(x.name, x.count) for x in self.f.tags.labels]
+        # the same order from the old cmp function
+        self.f.tags.sort(cmp_func=sort_by_count)
+        self.assertEqual([(x.name, x.count) for x in self.f.tags.labels], full)
+
+        # only the first labels, plus selected ones
+        self.f.tags.sort(limit=3)
+        self.assertEqual([(x.name, x.count) for x in self.f.tags.labels],
+                         full[:4])
+        self.f.tags.select_slugs('yellow')
+        self.f.tags.sort(sort_key=attrgetter('name'), limit=2)
+        self.assertEqual([x.name for x in self.f.tags.labels],
+                         ['all', 'blue', 'free', 'yellow'])
+
+    def test_labels_page(self):
+        self.f.colours.select_slugs('red')
+        self.f.update()
+        labels = [(x.name, x.count) for x in self.f.colours.labels[1:]]
+        self.assertEqual(self.f.colours.label_total, len(labels))
+
+        # the order doesn't depend on counts, so only the page is counted
+        self.f.invalidate()
+        page = self.f.colours.labels_page(2, 3)
+        self.assertEqual([(x.name, x.count) for x in page], labels[2:5])
+        self.assertEqual(self.f.colours.labels[1]._count, None)
+        self.assertEqual([x.name for x in self.f.colours.labels_page(6)],
+                         [name for name, count in labels[6:]])
+
+        tags = [(x.name, x.count) for x in self.f.tags.labels[1:]]
+        self.assertEqual([(x.name, x.count)
+                          for x in self.f.tags.labels_page(1, 2)], tags[1:3])
@@ -0,0 +1,68 @@
+from django.test import TestCase
+
+from facettools.bitmaps import ItemBitmap, ItemRegistry
+
+from .models import ShopItem, Colour, ShopItemFacetGroup, \
+    BitmapShopItemFacetGroup
+from .utils import create_shop_items, check_equivalent
+
+
+class TestItemBitmap(TestCase):
+
+    def test_set_operations(self):
+        registry = ItemRegistry()
+        # spread across several chunks
+        a = ItemBitmap.from_ids(registry, [1, 5, 70000, 200000])
+        b = ItemBitmap.from_ids(registry, [5, 6, 200000])
+
+        self.assertEqual(list((a & b).ids()), [5, 200000])
+        self.assertEqual(list((a | b).ids()), [1, 5, 6, 70000, 200000])
+        self.assertEqual(list((a - b).ids()), [1, 70000])
+        self.assertEqual(len(a), 4)
+        self.assertEqual(a.intersection_count(b), 2)
+        self.assertTrue(a.has_id(70000))
+        self.assertFalse(a.has_id(70001))
+
+        c = a.copy()
+        c &= ItemBitmap.from_ids(registry, [3])
+        self.assertFalse(c)
+        self.assertEqual(c._chunks, {}) # empty chunks are dropped
+        self.assertEqual(len(a), 4)
+
+    def test_items(self):
+        registry = ItemRegistry()
+        a = ItemBitmap(registry, ['x', 'y'])
+        a.add('z')
+        a.discard('x')
+        a.discard('never seen')
+        self.assertEqual(list(a), ['y', 'z'])
+        self.assertTrue('y' in a)
+        self.assertFalse('x' in a)
+        self.assertEqual(a & set(['z', 'w']), ItemBitmap(registry, ['z']))
+
+    def test_registries_dont_mix(self):
+        a = ItemBitmap(ItemRegistry(), ['x'])
+        b = ItemBitmap(ItemRegistry(), ['x'])
+        self.assertRaises(ValueError, lambda: a & b)
+
+
+class TestBitmapFacets(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+        self.f = ShopItemFacetGroup()
+        self.f.rebuild_index()
+        self.bf = BitmapShopItemFacetGroup()
+        self.bf.rebuild_index()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_storage(self):
+        self.assertIsInstance(self.bf.colours['red'].items, ItemBitmap)
+        self.assertEqual(set(self.bf.colours['red'].items),
+                         set(self.f.colours['red'].items))
+
+    def test_counts(self):
+        check_equivalent(self, self.f, self.bf)
@@ -0,0 +1,168 @@
+from django.test import TestCase
+
+from facettools.base import Facet
+from facettools.model_base import ModelFacetGroup
+
+from .models import ShopItem, Colour, ShopItemFacetGroup, \
+    PkShopItemFacetGroup
+from .utils import create_shop_items, check_counts, check_equivalent
+
+
+class ChunkedShopItemFacetGroup(ShopItemFacetGroup):
+    chunk_size = 3
+
+
+class FieldFacetGroup(ModelFacetGroup):
+    app_label = "facettools"
+    index_pks = True
+
+    def unfiltered_collection(self):
+        return ShopItem.objects.all()
+
+    def declare_facets(self):
+        self.facets['colours'] = Facet(
+            name="the colours",
+            group=self,
+            select_multiple=True,
+            field="colours__name",
+        )
+        self.facets['archived'] = Facet(
+            name="archived",
+            group=self,
+            field="is_archived",
+        )
+
+
+class PropertyFieldFacetGroup(FieldFacetGroup):
+    """
+    Also declares a facet whose field is a property of the model.
+    """
+    def declare_facets(self):
+        super(PropertyFieldFacetGroup, self).declare_facets()
+        self.facets['kind'] = Facet(name="kind", group=self, field="kind")
+
+
+class MixedFieldFacetGroup(ShopItemFacetGroup):
+    """
+    Declares colours by field, but still calls get_FOO_facet for the others.
+    """
+    def declare_facets(self):
+        super(MixedFieldFacetGroup, self).declare_facets()
+        self.facets['colours'].field = "colours__name"
+
+
+class InProcessPool(object):
+    """
+    Runs "worker" jobs in this process, which can see the test database.
+    """
+    map = staticmethod(map)
+
+
+class TestRebuildIndex(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_chunked(self):
+        f = ChunkedShopItemFacetGroup()
+        self.assertEqual([x.pk for x in f.iter_collection()],
+                         sorted(ShopItem.objects.values_list('pk', flat=True)))
+
+        # 8 items in chunks of 3, with the colours prefetched for each chunk
+        self.assertNumQueries(6, f.rebuild_index)
+
+        f.colours.select_slugs('red', 'blue')
+        f.update()
+        self.assertEqual(set(f.matching_items()), set([self.red_shirt,
+            self.blue_shirt, self.red_and_yellow_shirt, self.rainbow_shirt]))
+        check_counts(self, f.price, (
+            ('any price', 4, True),
+            ('free', 0, False),
+            ('$0-$50', 2, False),
+            ('$50-$100', 3, False),
+            ('$100 or more', 2, False),
+        ))
+
+    def _check_field_facets(self, f):
+        f.colours.select_slugs('red')
+        f.update()
+        self.assertEqual(set(f.queryset()), set([self.red_shirt,
+            self.red_and_yellow_shirt, self.rainbow_shirt]))
+        check_counts(self, f.colours, (
+            ('all', 8, False),
+            ('blue', 2, False),
+            ('green', 2, False),
+            ('indigo', 1, False),
+            ('orange', 1, False),
+            ('red', 3, True),
+            ('violet', 2, False),
+            ('yellow', 3, False),
+        ))
+
+    def test_field_facets(self):
+        f = FieldFacetGroup()
+        # one query per facet, plus one for the pks, and no items loaded
+        self.assertNumQueries(3, f.rebuild_index)
+        self._check_field_facets(f)
+        self.assertEqual(set(f.archived['true'].items),
+                         set([self.old_fashioned_shirt.pk]))
+
+        # single items are indexed by following the path
+        self.blue_shirt.colours.add(self.red)
+        f.unindex_item(self.blue_shirt)
+        f.index_item(self.blue_shirt)
+        f.update()
+        self.assertEqual(f.colours['red'].count, 4)
+
+    def test_property_field_facets(self):
+        f = PropertyFieldFacetGroup()
+        f.rebuild_index()
+        self._check_field_facets(f)
+        self.assertEqual(set(f.kind['vacuum'].items),
+                         set([self.null_item.pk]))
+        self.assertEqual(len(f.kind['shirt'].items), 7)
+        # it could depend on any field, so every save reindexes
+        self.assertEqual(f.tracked_fields(ShopItem), {})
+
+    def test_mixed_field_facets(self):
+        f = MixedFieldFacetGroup()
+        f.rebuild_index()
+        # 'archived' facets default to "no", so override them
+        for facet in f:
+            if facet.slug.startswith('archived'):
+                facet.select_slugs(facet.all_label_slug)
+        self._check_field_facets(f)
+
+    def test_parallel(self):
+        f = ShopItemFacetGroup()
+        f.rebuild_index()
+        pf = ChunkedShopItemFacetGroup()
+        pf.rebuild_index_parallel(processes=2, pool=InProcessPool())
+        check_equivalent(self, f, pf)
+        self.assertEqual(pf.price['free'].name, 'free')
+
+    def test_reindex_queryset(self):
+        f = PkShopItemFacetGroup()
+        f.rebuild_index()
+        # changes that send no signals
+        ShopItem.objects.filter(dollars=50).update(dollars=20)
+        ShopItem.objects.filter(pk=self.null_item.pk).update(is_archived=True)
+        ShopItem.objects.bulk_create([ShopItem(name="hat", dollars=0)])
+        self.blue_shirt.colours.add(self.red)
+
+        # the pks, then the items in one chunk, and their colours
+        self.assertNumQueries(3, f.reindex_queryset, ShopItem.objects.exclude(
+            dollars__gt=20))
+        rebuilt = PkShopItemFacetGroup()
+        rebuilt.rebuild_index()
+        check_equivalent(self, rebuilt, f)
+
+        pks = [self.red_shirt.pk, ShopItem.objects.get(name="hat").pk]
+        ShopItem.objects.filter(pk__in=pks).delete()
+        f.unindex_pks(pks)
+        rebuilt.rebuild_index()
+        check_equivalent(self, rebuilt, f)
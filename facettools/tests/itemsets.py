@@ -0,0 +1,83 @@
+from django.test import TestCase
+
+from facettools import itemsets
+from facettools.itemsets import ChunkedItemDict, ChunkedItemSet
+
+
+class TestChunkedItemSet(TestCase):
+
+    def setUp(self):
+        # split early, to test several chunks
+        self.chunk_size = itemsets.CHUNK_SIZE
+        itemsets.CHUNK_SIZE = 4
+
+    def tearDown(self):
+        itemsets.CHUNK_SIZE = self.chunk_size
+
+    def test_set_operations(self):
+        a = ChunkedItemSet(range(100))
+        b = ChunkedItemSet(range(90, 95))
+        self.assertEqual(len(a), 100)
+        self.assertTrue(len(a._chunks) > 1)
+        self.assertEqual(a, set(range(100)))
+        self.assertTrue(50 in a)
+        self.assertFalse(100 in a)
+
+        self.assertEqual(a & b, set(range(90, 95)))
+        self.assertEqual(b & a, set(range(90, 95)))
+        self.assertEqual(a & set([5, 500]), set([5]))
+        self.assertEqual(set([5, 500]) & a, set([5]))
+        self.assertEqual(a.intersection_count(b), 5)
+        self.assertEqual(a.intersection_count(a.copy()), 100)
+        self.assertEqual(a.intersection_count(set([5, 500])), 1)
+        self.assertEqual(a | set([500]), set(range(100) + [500]))
+        self.assertEqual(a.to_set(), set(range(100)))
+        self.assertEqual(type(itemsets.working_copy(a)), set)
+
+        b |= [1, 2]
+        b.discard(90)
+        b.discard(1000)
+        self.assertEqual(sorted(b), [1, 2, 91, 92, 93, 94])
+
+    def test_copies_share_chunks(self):
+        a = ChunkedItemSet(range(100))
+        b = a.copy()
+        b.add(100)
+        b.discard(3)
+        self.assertEqual(a, set(range(100)))
+        self.assertEqual(b, set(range(100) + [100]) - set([3]))
+        # only the chunks that changed were copied
+        shared = sum(x is y for x, y in zip(a._chunks, b._chunks))
+        self.assertEqual(shared, len(a._chunks) - 2)
+        # nor are the original's changes seen by the copy
+        a.discard(50)
+        self.assertTrue(50 in b)
+
+
+class TestChunkedItemDict(TestCase):
+
+    def setUp(self):
+        self.chunk_size = itemsets.CHUNK_SIZE
+        itemsets.CHUNK_SIZE = 4
+
+    def tearDown(self):
+        itemsets.CHUNK_SIZE = self.chunk_size
+
+    def test_copies_share_chunks(self):
+        a = ChunkedItemDict((i, i * 2) for i in range(100))
+        self.assertEqual(len(a), 100)
+        self.assertTrue(len(a.chunks()) > 1)
+        self.assertEqual(dict(a.iteritems()),
+                         dict((i, i * 2) for i in range(100)))
+        self.assertEqual(a.changed_chunks(), range(len(a.chunks())))
+
+        b = a.copy()
+        b[100] = 0
+        self.assertEqual(b.pop(3), 6)
+        self.assertEqual((len(a), a[3], a.get(100)), (100, 6, None))
+        self.assertEqual((len(b), b[100], 3 in b), (100, 0, False))
+        # only the chunks that changed were copied, and are to be stored
+        changed = b.changed_chunks()
+        self.assertEqual(len(changed), 2)
+        for i, (x, y) in enumerate(zip(a.chunks(), b.chunks())):
+            self.assertEqual(x is not y, i in changed)
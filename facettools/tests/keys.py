@@ -0,0 +1,33 @@
+from django.test import TestCase
+
+from .models import ShopItem, Colour, ShopItemFacetGroup, PkShopItemFacetGroup
+from .utils import create_shop_items, check_equivalent
+
+
+class TestPkIndex(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+        self.f = ShopItemFacetGroup()
+        self.f.rebuild_index()
+        self.pf = PkShopItemFacetGroup()
+        self.pf.rebuild_index()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_stores_pks(self):
+        self.assertEqual(set(self.pf.colours['red'].items),
+                         set([self.red_shirt.pk, self.red_and_yellow_shirt.pk,
+                              self.rainbow_shirt.pk]))
+        self.pf.colours.select_slugs('yellow')
+        self.pf.update()
+        self.assertEqual(set(self.pf.matching_items()),
+                         set([self.red_and_yellow_shirt.pk,
+                              self.rainbow_shirt.pk]))
+        self.assertEqual(set(self.pf.queryset()),
+                         set([self.red_and_yellow_shirt, self.rainbow_shirt]))
+
+    def test_counts(self):
+        check_equivalent(self, self.f, self.pf)
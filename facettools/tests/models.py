@@ -18,10 +18,15 @@ class ShopItem(models.Model):
     dollars = models.IntegerField(null=True)
     colours = models.ManyToManyField(Colour, null=True)
     is_archived = models.BooleanField(default=False)
+    released = models.DateField(null=True)
 
     def __unicode__(self):
         return "%s ($%s)" % (self.name, self.dollars)
 
+    @property
+    def kind(self):
+        return self.name.rsplit(' ', 1)[-1]
+
     class Meta:
         app_label="facettools"
 
@@ -67,6 +72,7 @@ class ShopItemFacetGroup(ModelFacetGroup):
             group=self,
             slug="colours",
             select_multiple=True,
+            prefetch_related=["colours"],
         )
         #selecting multiple colours  has an OR effect.
         self.facets['tags'] = Facet(
@@ -75,7 +81,8 @@ class ShopItemFacetGroup(ModelFacetGroup):
             slug="tags",
             select_multiple=True,
             intersect_if_multiple=True,
-            cmp_func=sort_by_count
+            cmp_func=sort_by_count,
+            prefetch_related=["colours"],
         ) #selecting multiple tags has an AND effect
 
         # Four similar facets that test the hide_all and default options
@@ -121,4 +128,11 @@ class ShopItemFacetGroup(ModelFacetGroup):
     def get_archived4_facet(self, obj):
         return "yes" if obj.is_archived else "no"
 
-    get_archived1_facet = get_archived2_facet = get_archived3_facet = get_archived4_facet
\ No newline at end of file
+    get_archived1_facet = get_archived2_facet = get_archived3_facet = get_archived4_facet
+
+class BitmapShopItemFacetGroup(ShopItemFacetGroup):
+    use_bitmaps = True
+
+
+class PkShopItemFacetGroup(ShopItemFacetGroup):
+    index_pks = True
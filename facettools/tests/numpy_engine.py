@@ -0,0 +1,67 @@
+from django.test import TestCase
+from django.utils.unittest import skipIf
+
+try:
+    from facettools.numpy_engine import NumpyCountEngine
+except ImportError:
+    NumpyCountEngine = None
+
+from .models import ShopItem, Colour, ShopItemFacetGroup, \
+    BitmapShopItemFacetGroup
+from .utils import create_shop_items, check_equivalent
+
+
+@skipIf(NumpyCountEngine is None, "numpy is not installed")
+class TestNumpyCountEngine(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+        self.f = ShopItemFacetGroup()
+        self.f.rebuild_index()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def _group(self, group_class, engine_class=NumpyCountEngine):
+        class NumpyFacetGroup(group_class):
+            count_engine = engine_class
+        group = NumpyFacetGroup()
+        group.rebuild_index()
+        return group
+
+    def test_counts(self):
+        nf = self._group(ShopItemFacetGroup)
+        self.assertIsInstance(nf._count_engine, NumpyCountEngine)
+        check_equivalent(self, self.f, nf)
+        # selections share the engine
+        check_equivalent(self, self.f, nf.selection())
+
+    def test_bitmap_counts(self):
+        check_equivalent(self, self.f, self._group(BitmapShopItemFacetGroup))
+
+    def test_index_changes(self):
+        nf = self._group(ShopItemFacetGroup)
+        self.red_shirt.colours.add(self.blue)
+        nf.index_item(self.red_shirt)
+        self.assertEqual(nf._count_engine, None)
+        nf.update()
+        self.assertEqual(nf.colours['blue'].count, 3)
+
+    def test_shared_engine(self):
+        built = []
+
+        class CountingEngine(NumpyCountEngine):
+            def __init__(self, group):
+                built.append(group)
+                super(CountingEngine, self).__init__(group)
+
+        nf = self._group(ShopItemFacetGroup, CountingEngine)
+        self.red_shirt.colours.add(self.blue)
+        nf.index_item(self.red_shirt)
+        del built[:]
+        # rebuilt once after the change, by the first selection, for every
+        # selection
+        for i in range(5):
+            self.assertEqual(nf.selection().colours['blue'].count, 3)
+        self.assertEqual(len(built), 1)
@@ -0,0 +1,286 @@
+from datetime import date, datetime
+
+from django.core.cache import get_cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from facettools.base import Facet
+from facettools.model_base import ModelFacetGroup
+from facettools import ranges
+from facettools.ranges import DateFacet, RangeFacet, SortedValues, \
+    value_order
+from facettools.storage import CacheStorage
+
+from .models import ShopItem, Colour
+from .utils import create_shop_items
+
+
+class PriceFacetGroup(ModelFacetGroup):
+    app_label = "facettools"
+    index_pks = True
+
+    def unfiltered_collection(self):
+        return ShopItem.objects.all()
+
+    def declare_facets(self):
+        self.facets['price'] = RangeFacet(
+            name="the price",
+            group=self,
+            slug="price",
+            field="dollars",
+            buckets=[
+                ("under $50", None, 50),
+                ("$50-$100", 50, 100),
+                ("$100 or more", 100, None),
+            ],
+        )
+        self.facets['colours'] = Facet(name="the colours", group=self,
+                                       field="colours__name")
+
+
+def labels(facet):
+    return [(x.name, x.count) for x in facet.labels]
+
+
+class TestRangeFacet(TestCase):
+    def setUp(self):
+        create_shop_items(self)
+        self.f = PriceFacetGroup()
+        self.f.rebuild_index()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_buckets(self):
+        self.assertEqual(labels(self.f.price), [
+            ('all', 8),
+            ('under $50', 2),
+            ('$50-$100', 3),
+            ('$100 or more', 2),
+        ])
+        self.f.colours.select_slugs('red')
+        self.f.update()
+        self.assertEqual(labels(self.f.price), [
+            ('all', 3),
+            ('under $50', 0),
+            ('$50-$100', 1),
+            ('$100 or more', 2),
+        ])
+
+        # buckets can change without reindexing
+        selection = self.f.selection()
+        selection.price.set_buckets([("cheap", None, 10), ("dear", 10, None)])
+        selection.update()
+        self.assertEqual(labels(selection.price),
+                         [('all', 3), ('cheap', 0), ('dear', 3)])
+
+    def test_select_range(self):
+        selection = self.f.selection(RequestFactory().get('/?price=20-75'))
+        self.assertEqual(set(selection.matching_items()),
+                         set([self.red_shirt.pk, self.green_shirt.pk,
+                              self.blue_shirt.pk]))
+        self.assertEqual(labels(selection.colours)[0], ('all', 3))
+        # the range is shown with the buckets, while it's selected
+        self.assertTrue(selection.price['20-75'].is_selected)
+        selection.clear_selection()
+        self.assertFalse('20-75' in selection.price._label_dict)
+
+    def test_index_changes(self):
+        self.f.watch_model(ShopItem)
+        try:
+            self.red_shirt.dollars = 120
+            self.red_shirt.save()
+            self.blue_shirt.delete()
+        finally:
+            self.f.unwatch_model(ShopItem)
+        self.f.update()
+        self.assertEqual(labels(self.f.price), [
+            ('all', 7),
+            ('under $50', 2),
+            ('$50-$100', 1),
+            ('$100 or more', 3),
+        ])
+        # the arrays are kept in the order they'd be sorted into
+        sorted_values = self.f.price.sorted_values()
+        self.f.price._sorted = None
+        self.assertEqual(list(self.f.price.sorted_values()),
+                         list(sorted_values))
+
+    def test_count_engine(self):
+        try:
+            from facettools.numpy_engine import NumpyCountEngine
+        except ImportError:
+            return
+        class EnginePriceFacetGroup(PriceFacetGroup):
+            count_engine = NumpyCountEngine
+        f = EnginePriceFacetGroup()
+        f.rebuild_index()
+        request = RequestFactory().get('/?price=20-75')
+        for group in (self.f, f):
+            selection = group.selection(request)
+            selection.colours.select_slugs('red')
+            selection.update()
+            self.assertEqual(labels(selection.price), [
+                ('all', 3),
+                ('under $50', 0),
+                ('20-75', 1),
+                ('$50-$100', 1),
+                ('$100 or more', 2),
+            ])
+        # counted by the engine, from the sorted values it was built with
+        everything = (0, len(selection.price.sorted_values()))
+        engine = f.get_count_engine()
+        self.assertEqual(engine.range_counts(
+            selection.price, [everything]), [3])
+        # the range is masked from its slice of the sorted values
+        self.assertEqual(
+            sum(bin(byte).count('1') for byte in
+                engine.label_mask(selection.price['20-75']).tolist()), 3)
+        # 'all' holds every item, so it needs no mask of its own
+        self.assertTrue(engine.facet_mask(f.selection().price)
+                        is engine.everything)
+
+    def test_storage(self):
+        class StoredPriceFacetGroup(PriceFacetGroup):
+            storage = CacheStorage(get_cache(
+                'django.core.cache.backends.locmem.LocMemCache'))
+        StoredPriceFacetGroup().rebuild_index()
+        f = StoredPriceFacetGroup()
+        self.assertTrue(f.load_index())
+        self.assertEqual(labels(f.price), labels(self.f.price))
+
+        # a change stores just the chunk of values it changed
+        stored = []
+        f.storage.set_many = lambda data: stored.extend(data)
+        self.red_shirt.dollars = 120
+        f.index_item(self.red_shirt)
+        self.assertEqual(len([key for key in stored if '___values' in key]),
+                         1)
+        self.assertEqual(f.price._values[self.red_shirt.pk], 120)
+
+
+class TestSortedValues(TestCase):
+    def setUp(self):
+        # small blocks, to test several
+        self.block_size = ranges.BLOCK_SIZE
+        ranges.BLOCK_SIZE = 4
+        self.values = dict((key, key % 7) for key in range(50))
+        self.sorted = SortedValues(
+            sorted(self.values.items(), key=value_order))
+
+    def tearDown(self):
+        ranges.BLOCK_SIZE = self.block_size
+
+    def check(self, sorted_values, values):
+        pairs = sorted(values.items(), key=value_order)
+        self.assertEqual(list(sorted_values),
+                         [(value, key) for key, value in pairs])
+        for value in range(-1, 9):
+            position = sorted_values.bisect(value)
+            self.assertEqual(position, len([key for key in values
+                                            if values[key] < value]))
+            if position < len(pairs):
+                self.assertEqual(sorted_values.value_at(position),
+                                 pairs[position][1])
+        self.assertEqual(sorted_values.keys_between(5, 23),
+                         [key for key, value in pairs[5:23]])
+
+    def test_changes(self):
+        self.check(self.sorted, self.values)
+        changed = self.sorted.copy()
+        values = dict(self.values)
+        for key in range(50, 70):
+            values[key] = 3
+            changed.insert(3, key)
+        # (emptying the first blocks)
+        for key in sorted(values, key=values.get)[:10] + range(1, 50, 3):
+            if key in values:
+                changed.remove(values.pop(key), key)
+        self.check(changed, values)
+        # the copy's changes aren't seen by the original, which shares the
+        # blocks that weren't changed
+        self.check(self.sorted, self.values)
+        self.assertTrue(set(map(id, self.sorted._values)) &
+                        set(map(id, changed._values)))
+
+
+class ReleaseFacetGroup(ModelFacetGroup):
+    app_label = "facettools"
+    index_pks = True
+
+    def unfiltered_collection(self):
+        return ShopItem.objects.all()
+
+    def declare_facets(self):
+        self.facets['released'] = DateFacet(name="released", group=self,
+                                            field="released")
+        self.facets['colours'] = Facet(name="the colours", group=self,
+                                       field="colours__name")
+
+
+class TestDateFacet(TestCase):
+    def setUp(self):
+        create_shop_items(self)
+        for item, released in (
+            (self.red_shirt, date(1989, 12, 31)),
+            (self.green_shirt, date(1994, 3, 1)),
+            (self.blue_shirt, datetime(1994, 3, 20, 12, 0)),
+            (self.rainbow_shirt, date(2003, 11, 5)),
+        ):
+            item.released = released
+            item.save()
+        self.f = ReleaseFacetGroup()
+        self.f.rebuild_index()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_granularities(self):
+        self.assertEqual(labels(self.f.released), [
+            ('all', 8),
+            ('1989', 1),
+            ('1994', 2),
+            ('2003', 1),
+        ])
+        # other granularities are rolled up from the same index
+        selection = self.f.selection()
+        selection.released.set_granularity('decade')
+        selection.update()
+        self.assertEqual(labels(selection.released), [
+            ('all', 8),
+            ('1980s', 1),
+            ('1990s', 2),
+            ('2000s', 1),
+        ])
+        selection.released.set_granularity('month')
+        selection.colours.select_slugs('blue')
+        selection.update()
+        self.assertEqual(labels(selection.released), [
+            ('all', 2),
+            ('December 1989', 0),
+            ('March 1994', 1),
+            ('November 2003', 1),
+        ])
+
+    def test_select_period(self):
+        selection = self.f.selection(RequestFactory().get('/?released=1990s'))
+        self.assertEqual(set(selection.matching_items()),
+                         set([self.green_shirt.pk, self.blue_shirt.pk]))
+        self.assertEqual(selection.released['1990s'].count, 2)
+
+        # new dates make new periods
+        self.null_item.released = date(2011, 1, 1)
+        self.null_item.save()
+        self.f.reindex_pks([self.null_item.pk])
+        self.f.update()
+        self.assertEqual(self.f.released['2011'].count, 1)
+
+    def test_shared_periods(self):
+        self.f.reindex_pks([self.red_shirt.pk])
+        # after a change, the periods are rolled up once, for every selection
+        periods = self.f.selection().released.periods()
+        self.assertTrue(self.f.selection().released.periods() is periods)
+        self.assertEqual([slug for slug, name, low, high in periods],
+                         ['1989', '1994', '2003'])
@@ -0,0 +1,224 @@
+import threading
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from facettools.base import FacetGroup
+
+from .models import ShopItem, Colour, ShopItemFacetGroup
+from .utils import create_shop_items, check_counts
+
+
+class WatchedShopItemFacetGroup(ShopItemFacetGroup):
+
+    def during_rebuild(self):
+        pass
+
+    def after_indexing(self):
+        pass
+
+    def index_collection(self, *args):
+        self.during_rebuild()
+        super(WatchedShopItemFacetGroup, self).index_collection(*args)
+        self.after_indexing()
+
+
+class TestSelection(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+        self.f = ShopItemFacetGroup()
+        self.f.rebuild_index()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_independent_selections(self):
+        free = self.f.selection(self.factory.get('/', {'price': 'free'}))
+        red = self.f.selection(self.factory.get('/', {'colours': 'red'}))
+
+        self.assertTrue(free.is_filtered)
+        self.assertEqual(set(free.matching_items()),
+                         set([self.free_violet_shirt]))
+        self.assertEqual(set(red.matching_items()), set([self.red_shirt,
+            self.red_and_yellow_shirt, self.rainbow_shirt]))
+
+        check_counts(self, free.colours, (
+            ('all', 1, True),
+            ('blue', 0, False),
+            ('green', 0, False),
+            ('indigo', 0, False),
+            ('orange', 0, False),
+            ('red', 0, False),
+            ('violet', 1, False),
+            ('yellow', 0, False),
+        ))
+        self.assertEqual(red.colours['red'].is_selected, True)
+        self.assertEqual(red.price['free'].count, 0)
+
+        # the index itself is untouched, and shares its items
+        self.assertFalse(self.f.is_filtered)
+        self.assertEqual(self.f.colours['red'].is_selected, False)
+        self.assertEqual(self.f.price['free'].count, 1)
+        self.assertTrue(red.colours['red'].items is
+                        self.f.colours['red'].items)
+
+    def test_threads(self):
+        results = {}
+        def count(slug):
+            selection = self.f.selection()
+            selection.colours.select_slugs(slug)
+            selection.update()
+            for i in range(20):
+                selection.invalidate()
+                results[slug] = [(x.name, x.count) for x in
+                                 selection.tags.labels]
+
+        threads = [threading.Thread(target=count, args=(slug,))
+                   for slug in ('red', 'blue', 'yellow')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for slug in ('red', 'blue', 'yellow'):
+            selection = self.f.selection()
+            selection.colours.select_slugs(slug)
+            selection.update()
+            self.assertEqual(results[slug], [(x.name, x.count) for x in
+                                             selection.tags.labels])
+
+    def test_swap_rebuild(self):
+        f = WatchedShopItemFacetGroup()
+        f.rebuild_index()
+        before = f.selection()
+        ShopItem.objects.create(name="red hat", dollars=5).colours.add(
+            self.red)
+
+        # the live index is whole while the new one is built
+        live_counts = []
+        f.during_rebuild = lambda: live_counts.append(
+            (f.colours['red'].count, f.selection().colours['red'].count))
+        f.rebuild_index(swap=True)
+        self.assertEqual(live_counts, [(3, 3)])
+
+        self.assertEqual(f.colours['red'].count, 4)
+        self.assertEqual(f.selection().colours['red'].count, 4)
+        self.assertTrue(f.colours.group is f)
+        self.assertTrue(f.colours['red'].facet is f.colours)
+        # a selection made before the swap keeps the old index
+        self.assertEqual(before.colours['red'].count, 3)
+        self.assertEqual(len(before.matching_items()), 7)
+
+    def test_changes_during_rebuild(self):
+        f = WatchedShopItemFacetGroup()
+        f.rebuild_index()
+        f.watch_model(ShopItem)
+        changes = [lambda: self.blue_shirt.colours.add(self.red)]
+        # made to the live index once the new one has read the items
+        f.after_indexing = lambda: changes and changes.pop()()
+        try:
+            f.rebuild_index(swap=True)
+        finally:
+            f.unwatch_model(ShopItem)
+        # and not lost when the new one is swapped in
+        self.assertEqual(f.colours['red'].count, 4)
+        self.assertTrue(self.blue_shirt.pk in
+                        [item.pk for item in f.colours['red'].items])
+
+    def test_catch_up_copies(self):
+        # by default, the changed items are copied from the live index
+        new_index = self.f.empty_copy()
+        new_index.rebuild_index(swap=False)
+        self.f.unindex_item(self.red_shirt)
+        self.f.unindex_item(self.blue_shirt)
+        self.f.index_item(self.blue_shirt)
+        FacetGroup.catch_up(self.f, new_index,
+                            [self.red_shirt, self.blue_shirt])
+        new_index.update()
+        self.f.update()
+        for facet in self.f:
+            self.assertEqual(
+                [(x.slug, x.count) for x in new_index.facets[facet.slug].labels],
+                [(x.slug, x.count) for x in facet.labels])
+
+    def test_selection_during_update(self):
+        counts = []
+        def count():
+            counts.append(self.f.selection().colours['red'].count)
+        with self.f.updating():
+            self.f.unindex_item(self.red_shirt)
+            thread = threading.Thread(target=count)
+            thread.start()
+            thread.join(5)
+            # made without waiting for the update, from the index before it
+            self.assertEqual(counts, [3])
+        self.assertEqual(self.f.selection().colours['red'].count, 2)
+
+    def test_label_copies(self):
+        # a selection only copies the labels it shows, selects or counts
+        self.f.colours.limit = 2
+        selection = self.f.selection(self.factory.get('/', {'price': 'free'}))
+        self.assertEqual([x.name for x in selection.colours.labels],
+                         ['all', 'blue', 'green'])
+        self.assertEqual(sorted(selection.colours._label_dict.copies),
+                         ['all', 'blue', 'green'])
+        self.assertEqual(selection.colours['violet'].count, 1)
+        self.assertFalse(self.f.colours['violet'] is
+                         selection.colours['violet'])
+
+    def test_shared_label_order(self):
+        # the order is worked out once per change to the index, and kept on
+        # the shared facet for every selection
+        slugs = self.f.selection().colours.sorted_slugs()
+        self.assertTrue(self.f.selection().colours.sorted_slugs() is slugs)
+
+        self.f.unindex_item(self.red_shirt)
+        self.assertFalse(self.f.selection().colours.sorted_slugs() is slugs)
+        slugs = self.f.selection().colours.sorted_slugs()
+        self.assertTrue(self.f.selection().colours.sorted_slugs() is slugs)
+
+    def test_concurrent_updates(self):
+        # loaded up front, as the test database can't be used from threads
+        items = list(ShopItem.objects.prefetch_related('colours')
+                     .filter(dollars__gte=50))
+        errors = []
+        snapshots = []
+
+        def write():
+            for i in range(5):
+                for item in items:
+                    self.f.unindex_item(item)
+                    self.f.index_item(item)
+
+        def read():
+            try:
+                for i in range(10):
+                    # the live index can be read while it changes
+                    for facet in self.f:
+                        for facet_label in facet._label_dict.values():
+                            list(facet_label.items)
+                    # and selections never see half an update
+                    selection = self.f.selection()
+                    snapshots.append(set(
+                        frozenset(facet[facet.all_label_slug].items)
+                        for facet in selection if not facet.hide_all
+                    ))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)] + \
+                  [threading.Thread(target=read) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for snapshot in snapshots:
+            self.assertEqual(len(snapshot), 1)
+        self.f.update()
+        self.assertEqual(self.f.colours['red'].count, 3)
+        self.assertEqual(self.f.price['50-100'].count, 4)
@@ -1,9 +1,43 @@
-from django.test import TestCase
+from django.http import HttpResponse
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+
+from facettools.base import Facet
+from facettools.middleware import FacetIndexMiddleware
+from facettools.model_base import ModelFacetGroup
 
 from .models import ShopItem, Colour, ShopItemFacetGroup
 from .utils import check_counts
 
 
+class DeferredShopItemFacetGroup(ShopItemFacetGroup):
+    defer_indexing = True
+
+
+class TrackingFacetGroup(ModelFacetGroup):
+    """
+    Says what its facets depend on, so that saves can skip them.
+    """
+    app_label = "facettools"
+    collection_depends_on = ()
+
+    def unfiltered_collection(self):
+        return ShopItem.objects.all()
+
+    def declare_facets(self):
+        self.facets['price'] = Facet(name="the price", slug="price",
+                                     group=self, depends_on=["dollars"])
+        self.facets['colours'] = Facet(name="the colours", group=self,
+                                       select_multiple=True,
+                                       field="colours__name")
+        self.facets['archived'] = Facet(name="archived", group=self,
+                                        field="is_archived")
+
+    def get_price_facet(self, obj):
+        return obj.get_price_facet()
+
+
 class TestModelSignals(TestCase):
     def setUp(self):
         self.f = ShopItemFacetGroup()
@@ -207,3 +241,228 @@ class TestModelSignals(TestCase):
             ('green', 1, False),
             ('red', 1, False),
         ))
+
+
+    def test_suspend_indexing(self):
+        suspended = self.f.suspend_indexing()
+        suspended.__enter__()
+        shirt = ShopItem.objects.create(name="red shirt", dollars=50)
+        shirt.colours.add(self.red, self.yellow)
+        shirt.dollars = 20
+        shirt.save()
+        ShopItem.objects.create(name="blue shirt", dollars=50).colours.add(
+            self.blue)
+        self.assertEqual(len(self.f.colours['all'].items), 0)
+
+        # one batch: the items, and their colours
+        self.assertNumQueries(2, suspended.__exit__, None, None, None)
+        self.f.update()
+        check_counts(self, self.f.colours, (
+            ('all', 2, True),
+            ('blue', 1, False),
+            ('red', 1, False),
+            ('yellow', 1, False),
+        ))
+
+
+class TestDeferredSignals(TestCase):
+    def setUp(self):
+        self.f = DeferredShopItemFacetGroup()
+        self.f.watch_model(ShopItem)
+        self.red = Colour.objects.create(name="red")
+        self.blue = Colour.objects.create(name="blue")
+        self.f.rebuild_index()
+
+    def tearDown(self):
+        self.f.unwatch_model(ShopItem)
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_coalesced(self):
+        shirt = ShopItem.objects.create(name="red shirt", dollars=50)
+        shirt.colours.add(self.red)
+        shirt.dollars = 10
+        shirt.save()
+        hat = ShopItem.objects.create(name="blue hat", dollars=100)
+        hat.colours.add(self.blue)
+        hat.save()
+
+        # (tests run in a transaction, so) nothing is indexed yet
+        self.assertEqual(len(self.f.colours['all'].items), 0)
+        # both items are reindexed once, in one query (and a prefetch)
+        self.assertNumQueries(2, self.f.flush)
+        self.f.update()
+        check_counts(self, self.f.price, (
+            ('any price', 2, True),
+            ('$0-$50', 1, False),
+            ('$50-$100', 1, False),
+            ('$100 or more', 1, False),
+        ))
+
+        hat.delete()
+        self.assertEqual(len(self.f.colours['all'].items), 2)
+        FacetIndexMiddleware().process_response(
+            RequestFactory().get('/'), HttpResponse())
+        self.f.update()
+        check_counts(self, self.f.colours, (
+            ('all', 1, True),
+            ('red', 1, False),
+        ))
+
+
+class TestDeferredRollback(TransactionTestCase):
+    def setUp(self):
+        self.f = DeferredShopItemFacetGroup()
+        self.f.watch_model(ShopItem)
+        self.f.rebuild_index()
+
+    def tearDown(self):
+        self.f.unwatch_model(ShopItem)
+        ShopItem.objects.all().delete()
+
+    def test_rollback(self):
+        with transaction.commit_manually():
+            ShopItem.objects.create(name="red shirt", dollars=50)
+            transaction.rollback()
+        # the rolled back pk is still queued, but doesn't stop later saves
+        # being indexed when they commit
+        ShopItem.objects.create(name="blue hat", dollars=100)
+        self.assertEqual(len(self.f.colours['all'].items), 1)
+
+
+class TestDirtyFields(TestCase):
+    def setUp(self):
+        self.red = Colour.objects.create(name="red")
+        self.blue = Colour.objects.create(name="blue")
+        self.shirt = ShopItem.objects.create(name="red shirt", dollars=50)
+        self.shirt.colours.add(self.red)
+        self.f = TrackingFacetGroup()
+        self.f.rebuild_index()
+        self.f.watch_model(ShopItem)
+
+    def tearDown(self):
+        self.f.unwatch_model(ShopItem)
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_skip_unaffected(self):
+        shirt = ShopItem.objects.get(pk=self.shirt.pk)
+        archived = self.f.archived['false']._items
+        # just the save's own SELECT and UPDATE: no facet reads the name
+        shirt.name = "scarlet shirt"
+        self.assertNumQueries(2, shirt.save)
+
+        # only the price is reindexed
+        shirt.dollars = 10
+        shirt.save()
+        self.assertTrue(self.f.archived['false']._items is archived)
+        self.f.update()
+        self.assertEqual([(x.name, x.count) for x in self.f.price.labels],
+                         [('all', 1), ('$0-$50', 1)])
+
+        # relations are reindexed when they change
+        shirt.colours.add(self.blue)
+        self.f.update()
+        self.assertEqual([(x.name, x.count) for x in self.f.colours.labels],
+                         [('all', 1), ('blue', 1), ('red', 1)])
+        self.blue.shopitem_set.clear()
+        self.f.update()
+        self.assertEqual([(x.name, x.count) for x in self.f.colours.labels],
+                         [('all', 1), ('red', 1)])
+
+
+class RelatedFacetGroup(ModelFacetGroup):
+    app_label = "facettools"
+
+    def unfiltered_collection(self):
+        return ShopItem.objects.all()
+
+    def declare_facets(self):
+        self.facets['colours'] = Facet(name="the colours", group=self,
+                                       field="colours__name",
+                                       related={Colour: "colours"})
+        self.facets['tags'] = Facet(name="the tags", group=self, slug="tags",
+                                    prefetch_related=["colours"],
+                                    related={Colour: "colours"})
+
+    def get_tags_facet(self, obj):
+        return [x.name.upper() for x in obj.colours.all()]
+
+
+class RelatedColourFacetGroup(RelatedFacetGroup):
+
+    def declare_facets(self):
+        super(RelatedColourFacetGroup, self).declare_facets()
+        del self.facets['tags']
+
+
+class TestRelatedChanges(TestCase):
+    def setUp(self):
+        self.red = Colour.objects.create(name="red")
+        self.blue = Colour.objects.create(name="blue")
+        self.shirt = ShopItem.objects.create(name="red shirt", dollars=50)
+        self.shirt.colours.add(self.red)
+        self.hat = ShopItem.objects.create(name="blue hat", dollars=50)
+        self.hat.colours.add(self.blue)
+        self.f = RelatedFacetGroup()
+        self.f.rebuild_index()
+        self.f.watch_model(ShopItem)
+
+    def tearDown(self):
+        self.f.unwatch_model(ShopItem)
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def labels(self, facet):
+        self.f.update()
+        return [(x.name, x.count) for x in facet.labels]
+
+    def test_rename(self):
+        red = self.f.colours['red']
+        self.red.name = "scarlet"
+        self.red.save()
+        # the label is renamed in place; the tags are reindexed
+        self.assertTrue(self.f.colours['scarlet']._items is red._items)
+        self.assertEqual(self.labels(self.f.colours),
+                         [('all', 2), ('blue', 1), ('scarlet', 1)])
+        self.assertEqual(self.labels(self.f.tags),
+                         [('all', 2), ('BLUE', 1), ('SCARLET', 1)])
+
+        # renaming onto another colour merges the labels
+        self.blue.name = "scarlet"
+        self.blue.save()
+        self.assertEqual(self.labels(self.f.colours),
+                         [('all', 2), ('scarlet', 2)])
+        # unindexing still finds the merged label
+        self.hat.delete()
+        self.assertEqual(self.labels(self.f.colours),
+                         [('all', 1), ('scarlet', 1)])
+
+    def test_rename_shared_slug(self):
+        self.hat.colours.add(Colour.objects.create(name="Red"))
+        self.f.reindex_pks([self.hat.pk])
+        self.red.name = "scarlet"
+        self.red.save()
+        # "Red" still gives the hat the label, so the shirt is reindexed
+        self.assertEqual(self.labels(self.f.colours),
+                         [('all', 2), ('blue', 1), ('red', 1),
+                          ('scarlet', 1)])
+
+    def test_unchanged(self):
+        f = RelatedColourFacetGroup()
+        f.rebuild_index()
+        f.watch_model(ShopItem)
+        try:
+            generation = f.index_generation
+            self.red.save()
+            # no name changed, so there's nothing to rename or reindex, and
+            # no update
+            self.assertEqual(f.index_generation, generation)
+        finally:
+            f.unwatch_model(ShopItem)
+
+    def test_delete(self):
+        self.blue.delete()
+        self.assertEqual(self.labels(self.f.colours),
+                         [('all', 2), ('red', 1)])
+        self.assertEqual(self.labels(self.f.tags), [('all', 2), ('RED', 1)])
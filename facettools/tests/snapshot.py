@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from facettools.snapshot import SnapshotItems
+
+from .models import ShopItem, Colour, ShopItemFacetGroup, PkShopItemFacetGroup
+from .utils import create_shop_items, check_equivalent
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+        self.f = ShopItemFacetGroup()
+        self.f.rebuild_index()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.snapshot')
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+        shutil.rmtree(self.directory)
+
+    def test_snapshot(self):
+        pf = PkShopItemFacetGroup()
+        self.assertFalse(pf.load_snapshot(self.path))
+        pf.rebuild_index()
+        pf.write_snapshot(self.path)
+
+        loaded = PkShopItemFacetGroup()
+        self.assertTrue(loaded.load_snapshot(self.path))
+        # items are read in place
+        red = loaded.colours['red']
+        self.assertIsInstance(red.items, SnapshotItems)
+        self.assertEqual(set(red.items), set(pf.colours['red'].items))
+        check_equivalent(self, self.f, loaded)
+
+        # selections share the views, and counting doesn't copy them
+        loaded.clear_selection()
+        selection = loaded.selection()
+        self.assertTrue(selection.colours['red'].items is red.items)
+        for facet in loaded:
+            for facet_label in facet._label_dict.values():
+                self.assertIsInstance(facet_label.items, SnapshotItems)
+
+        # only the labels that change are copied
+        loaded.unindex_key(self.red_shirt.pk)
+        self.assertFalse(isinstance(loaded.colours['red'].items,
+                                    SnapshotItems))
+        self.assertTrue(loaded.colours['blue'].items is
+                        selection.colours['blue'].items)
+        self.assertEqual(selection.colours['red'].count, 3)
+        loaded.update()
+        self.assertEqual(loaded.colours['red'].count, 2)
+
+    def test_stale(self):
+        pf = PkShopItemFacetGroup()
+        pf.rebuild_index()
+        pf.write_snapshot(self.path)
+
+        class NewerFacetGroup(PkShopItemFacetGroup):
+            storage_version = 2
+        f = NewerFacetGroup()
+        self.assertFalse(f.load_snapshot(self.path))
+        f.load_or_write_snapshot(self.path)
+        self.assertTrue(NewerFacetGroup().load_snapshot(self.path))
+        self.assertFalse(PkShopItemFacetGroup().load_snapshot(self.path))
+
+        open(self.path, 'wb').write('not a snapshot')
+        self.assertFalse(NewerFacetGroup().load_snapshot(self.path))
+
+    def test_integer_keys(self):
+        # model instances can't be written
+        self.assertRaises(ValueError, self.f.write_snapshot, self.path)
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,207 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from facettools import base, ranges
+from facettools.models import StoredIndexEntry
+from facettools.storage import CacheStorage, DatabaseStorage, FileStorage, \
+    decode_items, encode_items, safe_key
+
+from .models import ShopItem, Colour, ShopItemFacetGroup, PkShopItemFacetGroup
+from .utils import create_shop_items, check_equivalent
+
+
+class CountingStorage(CacheStorage):
+    """
+    Counts calls to the backend, i.e. round trips.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.calls = []
+        # the keys given to set_many
+        self.stored = []
+
+    def __getattribute__(self, name):
+        if name in ('get', 'set', 'delete', 'get_many', 'set_many',
+                    'delete_many'):
+            self.calls.append(name)
+        return super(CountingStorage, self).__getattribute__(name)
+
+    def set_many(self, data):
+        self.stored.extend(data)
+        super(CountingStorage, self).set_many(data)
+
+
+class TestStorage(TestCase):
+
+    def setUp(self):
+        create_shop_items(self)
+        self.f = ShopItemFacetGroup()
+        self.f.rebuild_index()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+        shutil.rmtree(self.directory)
+
+    def _group_class(self, storage, base=PkShopItemFacetGroup):
+        class StoredFacetGroup(base):
+            pass
+        StoredFacetGroup.storage = storage
+        return StoredFacetGroup
+
+    def test_encoding(self):
+        for keys in ([], [3, 1, 2], [2 ** 70, 1], ['a', u'b'], [-5, 5]):
+            data = encode_items(set(keys))
+            self.assertEqual(sorted(decode_items(data)), sorted(keys))
+        self.assertEqual(encode_items([1, 2])[0], 'd')
+        self.assertEqual(safe_key('abc.d-e_f'), 'abc.d-e_f')
+        self.assertEqual(len(safe_key('x' * 300)), 200)
+        self.assertNotEqual(safe_key('a b'), safe_key('a_b'))
+
+    def _check_storage(self, storage, base=PkShopItemFacetGroup):
+        group_class = self._group_class(storage, base)
+        self.assertFalse(group_class().load_index())
+
+        f = group_class()
+        f.rebuild_index()
+        loaded = group_class()
+        self.assertNumQueries(0, loaded.load_index)
+        check_equivalent(self, self.f, loaded)
+        return group_class
+
+    def test_cache_storage(self):
+        storage = CacheStorage()
+        storage.cache.clear()
+        self._check_storage(storage)
+        # items themselves can be stored too
+        storage.cache.clear()
+        self._check_storage(CacheStorage(timeout=60), ShopItemFacetGroup)
+
+    def test_database_storage(self):
+        group_class = self._group_class(DatabaseStorage())
+        self.assertFalse(group_class().load_index())
+        group_class().rebuild_index()
+        loaded = group_class()
+        # the generation, the manifests and the labels
+        self.assertNumQueries(3, loaded.load_index)
+        check_equivalent(self, self.f, loaded)
+        self.assertTrue(StoredIndexEntry.objects.count())
+
+        # an index missing one of its labels isn't loaded
+        StoredIndexEntry.objects.filter(key__contains='colours__red.').delete()
+        loaded = group_class()
+        self.assertFalse(loaded.load_index())
+        self.assertEqual(loaded.storage_generation, None)
+        self.assertEqual(len(loaded.colours['all'].items), 0)
+
+    def test_file_storage(self):
+        group_class = self._check_storage(FileStorage(self.directory))
+
+        # rebuilding replaces the previous generation
+        n_files = len(os.listdir(self.directory))
+        f = group_class()
+        f.rebuild_index()
+        self.assertEqual(len(os.listdir(self.directory)), n_files)
+
+        # changes are saved as they are made
+        item = ShopItem.objects.create(name="orange shirt", dollars=10)
+        item.colours.add(self.orange)
+        f.index_item(item)
+        f.unindex_item(self.null_item)
+        loaded = group_class()
+        self.assertTrue(loaded.load_index())
+        self.assertEqual(set(loaded.colours['orange'].items),
+                         set([item.pk, self.rainbow_shirt.pk]))
+        self.assertEqual(len(loaded.colours['all'].items), 8)
+
+    def test_batching(self):
+        storage = CountingStorage()
+        storage.cache.clear()
+        group_class = self._group_class(storage)
+
+        f = group_class()
+        f.rebuild_index()
+        self.assertEqual(storage.calls, ['get', 'set_many', 'set'])
+
+        del storage.calls[:]
+        f.rebuild_index()
+        # the old generation is deleted
+        self.assertEqual(storage.calls, ['get', 'set_many', 'set', 'get_many',
+                                         'delete_many'])
+
+        del storage.calls[:]
+        loaded = group_class()
+        self.assertTrue(loaded.load_index())
+        self.assertEqual(storage.calls, ['get', 'get_many', 'get_many'])
+        check_equivalent(self, self.f, loaded)
+
+    def test_unindexing(self):
+        storage = CountingStorage()
+        storage.cache.clear()
+        f = self._group_class(storage)()
+        f.rebuild_index()
+
+        del storage.calls[:]
+        del storage.stored[:]
+        f.unindex_item(self.red_shirt)
+        # one batch per facet, of just the labels that held the item
+        self.assertEqual(storage.calls, ['set_many'] * len(f.facets))
+        stored = set(key.rsplit(':', 1)[1].split('__', 2)[2]
+                     for key in storage.stored)
+        self.assertEqual(stored, set([
+            'price__any-price', 'price__0-50', 'price__50-100',
+            'colours__all', 'colours__red', 'tags__all', 'tags__red',
+            'tags__shirt', 'archived1__all', 'archived1__no',
+            'archived2__all', 'archived2__no', 'archived3__no',
+            'archived4__no',
+        ]))
+        self.assertEqual(f.colours['red'].items,
+                         set([self.red_and_yellow_shirt.pk,
+                              self.rainbow_shirt.pk]))
+
+        # labels left empty are removed, except 'all'
+        for item in ShopItem.objects.all():
+            f.unindex_item(item)
+        f.update()
+        self.assertEqual([(x.slug, x.count) for x in f.colours.labels],
+                         [('all', 0)])
+        f.index_item(self.blue_shirt)
+        f.update()
+        self.assertEqual([(x.slug, x.count) for x in f.colours.labels],
+                         [('all', 1), ('blue', 1)])
+
+    def test_rename(self):
+        storage = CountingStorage()
+        storage.cache.clear()
+        f = self._group_class(storage)()
+        f.rebuild_index()
+        old_key = f.storage_key(f.colours['red'].key)
+
+        del storage.calls[:]
+        f.colours.rename_label('red', 'scarlet')
+        # the old label is deleted in the same batch as the new one is saved
+        self.assertEqual(storage.calls, ['set_many', 'delete_many'])
+        self.assertEqual(storage.get(old_key), None)
+
+    def test_no_storage(self):
+        # without storage, changes aren't even encoded
+        def fail(*args):
+            raise AssertionError("encoded without storage")
+        encoders = [(module, name, getattr(module, name))
+                    for module in (base, ranges)
+                    for name in ('encode_items', 'encode_value')]
+        for module, name, encoder in encoders:
+            setattr(module, name, fail)
+        try:
+            self.f.rebuild_index()
+            self.f.unindex_item(self.red_shirt)
+            self.f.index_item(self.red_shirt)
+            self.f.colours.rename_label('red', 'scarlet')
+        finally:
+            for module, name, encoder in encoders:
+                setattr(module, name, encoder)
+        self.assertTrue(self.red_shirt in self.f.colours['scarlet'].items)
@@ -1,3 +1,6 @@
+from .models import ShopItem, Colour
+
+
 def check_counts(tc, facet, mapping):
     # check the list is complete
     tc.assertEqual(set([x.name for x in facet.labels]),
@@ -17,3 +20,85 @@ def check_counts(tc, facet, mapping):
                                                 fv.is_selected)
             raise e
         i += 1
+
+
+def create_shop_items(tc):
+    # the catalogue of colours and shirts that most tests share
+    tc.red = Colour.objects.create(name="red")
+    tc.orange = Colour.objects.create(name="orange")
+    tc.yellow = Colour.objects.create(name="yellow")
+    tc.green = Colour.objects.create(name="green")
+    tc.blue = Colour.objects.create(name="blue")
+    tc.indigo = Colour.objects.create(name="indigo")
+    tc.violet = Colour.objects.create(name="violet")
+
+    tc.null_item = ShopItem.objects.create(name="vacuum")
+    tc.free_violet_shirt = ShopItem.objects.create(name="violet shirt",
+                                                   dollars=0)
+    tc.free_violet_shirt.colours.add(tc.violet)
+
+    tc.red_shirt = ShopItem.objects.create(name="red shirt",
+                                                   dollars=50)
+    tc.red_shirt.colours.add(tc.red)
+
+    tc.green_shirt = ShopItem.objects.create(name="green shirt",
+                                                   dollars=50)
+    tc.green_shirt.colours.add(tc.green)
+
+    tc.blue_shirt = ShopItem.objects.create(name="blue shirt",
+                                                   dollars=50)
+    tc.blue_shirt.colours.add(tc.blue)
+
+    tc.red_and_yellow_shirt = ShopItem.objects.create(
+        name="red and yellow shirt", dollars=100
+    )
+    tc.red_and_yellow_shirt.colours.add(tc.red, tc.yellow)
+
+    tc.rainbow_shirt = ShopItem.objects.create(
+        name="rainbow shirt", dollars=400
+    )
+    tc.rainbow_shirt.colours.add(*list(Colour.objects.all()))
+
+    tc.old_fashioned_shirt = ShopItem.objects.create(
+        name="archived shirt", dollars = 2,
+        is_archived=True,
+    )
+    tc.old_fashioned_shirt.colours.add(tc.yellow)
+
+
+# a sequence of selections that exercises single-select, union and
+# intersection facets, for comparing alternative index implementations.
+SELECTIONS = (
+    {},
+    {'price': ['free']},
+    {'price': ['0-50']},
+    {'price': ['0-50'], 'colours': ['red']},
+    {'price': ['0-50'], 'colours': ['red', 'blue']},
+    {'colours': ['red', 'blue'], 'tags': ['blue', 'red']},
+    {'tags': ['shirt', 'multicoloured'], 'archived1': ['yes']},
+)
+
+
+def select(facet_group, selection):
+    facet_group.clear_selection()
+    for slug, values in selection.items():
+        facet_group.facets[slug].select_slugs(*values)
+    facet_group.update()
+
+
+def check_equivalent(tc, facet_group, other_group):
+    """
+    Check that two facet groups over the same collection agree on every
+    label's count, and on the matching queryset, for each of SELECTIONS.
+    """
+    for selection in SELECTIONS:
+        select(facet_group, selection)
+        select(other_group, selection)
+        tc.assertEqual(set(facet_group.queryset()),
+                       set(other_group.queryset()))
+        for facet in facet_group:
+            other_facet = other_group.facets[facet.slug]
+            tc.assertEqual(
+                [(x.name, x.count, x.is_selected) for x in facet.labels],
+                [(x.name, x.count, x.is_selected) for x in other_facet.labels]
+            )
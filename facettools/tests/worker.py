@@ -0,0 +1,115 @@
+from django.test import TestCase
+
+from facettools.worker import IndexingWorker
+
+from .models import ShopItem, Colour, ShopItemFacetGroup
+from .utils import check_counts
+
+
+class RecordingShopItemFacetGroup(ShopItemFacetGroup):
+    """
+    Records the batches it is asked to reindex, rather than use the test
+    database, which other threads can't see.
+    """
+    def reindex_pks(self, pks):
+        self.batches.append(list(pks))
+
+
+class FailingShopItemFacetGroup(RecordingShopItemFacetGroup):
+    """
+    Fails to reindex batches with pk 2 in them, `failures` times.
+    """
+    def reindex_pks(self, pks):
+        if 2 in pks and self.failures:
+            self.failures -= 1
+            raise ValueError(pks)
+        super(FailingShopItemFacetGroup, self).reindex_pks(pks)
+
+
+class TestIndexingWorker(TestCase):
+
+    def setUp(self):
+        self.red = Colour.objects.create(name="red")
+
+    def tearDown(self):
+        ShopItem.objects.all().delete()
+        Colour.objects.all().delete()
+
+    def test_batches(self):
+        f = RecordingShopItemFacetGroup()
+        f.batches = []
+        worker = IndexingWorker(f, debounce=0.05, batch_size=3)
+        worker.put([4, 1])
+        worker.put([2, 1])
+        self.assertEqual(worker.depth, 3)
+        self.assertTrue(worker.lag >= 0)
+
+        worker.start()
+        worker.put([5, 3])
+        self.assertTrue(worker.wait_until_indexed(timeout=5))
+        self.assertEqual(worker.depth, 0)
+        self.assertEqual(worker.lag, 0)
+        worker.stop()
+        # each pk once, in batches of up to 3
+        self.assertEqual(sorted(sum(f.batches, [])), [1, 2, 3, 4, 5])
+        self.assertTrue(max(len(batch) for batch in f.batches) <= 3)
+        self.assertEqual(worker.indexed, 5)
+        self.assertEqual(worker.batches, len(f.batches))
+
+    def test_retries(self):
+        f = FailingShopItemFacetGroup()
+        f.batches = []
+        f.failures = 2
+        worker = IndexingWorker(f, batch_size=2, max_retries=2)
+        worker.put([1, 2, 3])
+        self.assertTrue(worker.wait_until_indexed())
+        # the failed batch was queued again, until it was indexed
+        self.assertEqual(sorted(sum(f.batches, [])), [1, 2, 3])
+        self.assertEqual((worker.errors, worker.dropped), (2, 0))
+
+        # but only so many times
+        f.failures = 5
+        worker.put([2])
+        self.assertTrue(worker.wait_until_indexed())
+        self.assertEqual((worker.errors, worker.dropped), (5, 1))
+        self.assertEqual(worker.depth, 0)
+
+    def test_background_indexing(self):
+        f = ShopItemFacetGroup()
+        f.rebuild_index()
+        # (not started, so it indexes in this thread when waited for)
+        f.worker = IndexingWorker(f)
+        f.watch_model(ShopItem, background=True)
+        try:
+            shirt = ShopItem.objects.create(name="red shirt", dollars=50)
+            shirt.colours.add(self.red)
+            shirt.save()
+            self.assertEqual(f.worker.depth, 0)
+            f.flush()
+            self.assertEqual(f.worker.depth, 1)
+            self.assertTrue(f.wait_until_indexed())
+        finally:
+            f.unwatch_model(ShopItem)
+        # the worker is stopped once nothing is watched
+        self.assertEqual(f.worker, None)
+
+        f.update()
+        check_counts(self, f.colours, (
+            ('all', 1, True),
+            ('red', 1, False),
+        ))
+
+    def test_unwatch_stops_worker(self):
+        f = ShopItemFacetGroup()
+        f.rebuild_index()
+        f.worker = worker = IndexingWorker(f)
+        f.watch_model(ShopItem, background=True)
+        shirt = ShopItem.objects.create(name="red shirt", dollars=50)
+        shirt.colours.add(self.red)
+        f.flush()
+        self.assertEqual(worker.depth, 1)
+        # what was queued is indexed before it stops
+        f.unwatch_model(ShopItem)
+        self.assertEqual((worker.depth, worker.indexed), (0, 1))
+        f.update()
+        self.assertEqual(f.colours['red'].count, 1)
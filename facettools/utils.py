@@ -1,4 +1,5 @@
 import re
+from itertools import imap
 
 
 def get_verbose_name(class_name):
@@ -19,6 +20,47 @@ def sort_by_count(a, b):
         return cmp(a.name, b.name)
     return x
 
+def count_sort_key(facet_label):
+    """
+    A sort key that sorts by count (descending), then by name, like
+    `sort_by_count`, but reads each count once.
+    """
+    return (-facet_label.count, facet_label.name)
+
+def intersection_count(a, b):
+    """
+    Return len(a & b), without building the intersection.
+    """
+    if hasattr(a, 'intersection_count'):
+        return a.intersection_count(b)
+    if hasattr(b, 'intersection_count'):
+        return b.intersection_count(a)
+    if len(b) < len(a):
+        a, b = b, a
+    # test each member of the smaller set against the larger one
+    return sum(imap(b.__contains__, a))
+
+def get_path_values(obj, path):
+    """
+    Follow a django-style lookup path (e.g. "colours__name") of attributes
+    from `obj`, and return the list of values found at the end of it.
+    Managers and other iterables along the way are expanded, and None values
+    are dropped.
+    """
+    objs = [obj]
+    for attr in path.split('__'):
+        values = []
+        for o in objs:
+            value = getattr(o, attr, None)
+            if hasattr(value, 'all'): # a manager
+                value = value.all()
+            if is_iterable(value):
+                values.extend(v for v in value if v is not None)
+            elif value is not None:
+                values.append(value)
+        objs = values
+    return objs
+
 def is_iterable(obj):
     """Checks if the object is a non-string sequence."""
     return hasattr(obj, '__iter__') and not isinstance(obj, basestring)
@@ -7,11 +7,14 @@ It's simple enough to adapt to your own view, right?
 """
 
 """
+# build the index once per process, and share it between requests
+shop_item_facets = ShopItemFacetGroup()
+shop_item_facets.rebuild_index()
+
 def faceted_list(request):
 
-    facet_group = ShopItemFacetGroup()
-    facet_group.rebuild_index()
-    facet_group.apply_request(request)
+    # the request's selections, on the shared index
+    facet_group = shop_item_facets.selection(request)
 
     items = facet_group.queryset().order_by('name')
 
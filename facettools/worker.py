@@ -0,0 +1,205 @@
+"""
+A background thread that keeps a ModelFacetGroup's index up to date, so that
+request threads don't pay for indexing the items they change.
+
+Use it with `group.watch_model(Model, background=True)`. Signal handlers
+then queue the pks of changed items (see `ModelFacetGroup.defer_indexing`),
+and, once the transaction commits, hand them to the worker, which reindexes
+them in batches.
+"""
+import logging
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger('facettools')
+
+
+class IndexingWorker(object):
+    """
+    Reindexes the pks put on its queue, in batches of up to `batch_size` (by
+    default, the group's `chunk_size`).
+
+    Batches are debounced: the worker waits until no pks have been queued
+    for `debounce` seconds, so that a burst of changes is indexed together,
+    but no pk waits longer than `max_delay` seconds.
+
+    The pks of a batch that fails are queued again, up to `max_retries`
+    times, before they're given up on (and left stale until they next
+    change, or a rebuild).
+    """
+
+    def __init__(self, group, debounce=0.2, max_delay=5, batch_size=None,
+                 max_retries=3):
+        self.group = group
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.batch_size = batch_size or group.chunk_size
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        # pk -> when it was queued, for pks waiting, and pks being indexed
+        self._queued = {}
+        self._indexing = {}
+        # pk -> the number of times it has failed to index
+        self._failures = {}
+        self._last_queued = None
+        self._stopping = False
+        self._thread = None
+        # the number of pks and batches indexed, of batches that failed, and
+        # of pks given up on
+        self.indexed = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run,
+                                        name="facettools indexing worker")
+        # don't keep the process alive
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the worker, once it has indexed everything queued (in this
+        thread, if it isn't running).
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        else:
+            while self.process(block=False):
+                pass
+
+    def put(self, pks):
+        now = time.time()
+        with self._condition:
+            for pk in pks:
+                self._queued.setdefault(pk, now)
+            self._last_queued = now
+            self._condition.notify_all()
+
+    @property
+    def depth(self):
+        """
+        The number of pks waiting to be indexed, or being indexed.
+        """
+        with self._condition:
+            return len(self._queued) + len(self._indexing)
+
+    @property
+    def lag(self):
+        """
+        How long (in seconds) the oldest change that isn't indexed yet has
+        been queued, or 0 if there isn't one.
+        """
+        with self._condition:
+            times = self._queued.values() + self._indexing.values()
+        if not times:
+            return 0
+        return time.time() - min(times)
+
+    def _next_batch(self, block):
+        # with the condition held: wait for a batch to be due, and take it.
+        while True:
+            if not self._queued:
+                if not block or self._stopping:
+                    return None
+                self._condition.wait()
+                continue
+            if not block or self._stopping or \
+                    len(self._queued) >= self.batch_size:
+                break
+            now = time.time()
+            quiet = now - self._last_queued
+            waited = now - min(self._queued.values())
+            if quiet >= self.debounce or waited >= self.max_delay:
+                break
+            self._condition.wait(min(self.debounce - quiet,
+                                     self.max_delay - waited))
+
+        pks = sorted(self._queued)[:self.batch_size]
+        for pk in pks:
+            self._indexing[pk] = self._queued.pop(pk)
+        return pks
+
+    def process(self, block=True):
+        """
+        Index the next batch, waiting for one to be due if `block` is True.
+        Returns False if there was nothing to index (when blocking, that
+        only happens once the worker is stopped).
+        """
+        with self._condition:
+            pks = self._next_batch(block)
+        if pks is None:
+            return False
+        failed = False
+        try:
+            self.group.reindex_pks(pks)
+        except Exception:
+            failed = True
+            self.errors += 1
+            logger.exception("Couldn't index %s pks %r", self.group, pks)
+        else:
+            self.indexed += len(pks)
+            self.batches += 1
+        finally:
+            with self._condition:
+                now = time.time()
+                dropped = []
+                for pk in pks:
+                    del self._indexing[pk]
+                    if not failed:
+                        self._failures.pop(pk, None)
+                        continue
+                    failures = self._failures.get(pk, 0) + 1
+                    if failures > self.max_retries:
+                        del self._failures[pk]
+                        dropped.append(pk)
+                    else:
+                        # try again, once `debounce` has passed
+                        self._failures[pk] = failures
+                        self._queued.setdefault(pk, now)
+                        self._last_queued = now
+                self.dropped += len(dropped)
+                self._condition.notify_all()
+            if dropped:
+                logger.error("Gave up indexing %s pks %r", self.group, dropped)
+        return True
+
+    def run(self):
+        try:
+            while self.process():
+                pass
+        finally:
+            # connections are per thread, and this one is done
+            for connection in connections.all():
+                connection.close()
+
+    def wait_until_indexed(self, timeout=None):
+        """
+        Wait until everything queued so far is indexed, or `timeout` seconds
+        have passed. Returns False if they have.
+
+        If the worker isn't running, the queue is indexed in this thread.
+        """
+        if self._thread is None:
+            while self.process(block=False):
+                pass
+            return True
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._condition:
+            while self._queued or self._indexing:
+                if timeout is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+        return True